@@ -0,0 +1,76 @@
+"""Add media registry
+
+Revision ID: 3f9c1e7a2b6d
+Revises: b7b2a3b424b8
+Create Date: 2026-10-19 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9c1e7a2b6d'
+down_revision: Union[str, Sequence[str], None] = 'b7b2a3b424b8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Object key is the last part of the file URL (.../media/<key> or ...?filename=<key>)
+BACKFILL_MEDIA_SQL = """
+INSERT INTO media (key, owner_id, created_at)
+SELECT DISTINCT ON (key) regexp_replace(points.file, '^.*[/=]', '') AS key,
+       maps.owner_id,
+       now()
+FROM points
+JOIN maps ON maps.id = points.map_id
+WHERE points.file IS NOT NULL AND points.file <> ''
+ORDER BY key, maps.created_at
+ON CONFLICT DO NOTHING;
+"""
+
+BACKFILL_MAP_MEDIA_SQL = """
+INSERT INTO map_media (key, map_id, point_id)
+SELECT DISTINCT ON (key, points.map_id) regexp_replace(points.file, '^.*[/=]', '') AS key,
+       points.map_id,
+       points.id
+FROM points
+WHERE points.file IS NOT NULL AND points.file <> ''
+ORDER BY key, points.map_id
+ON CONFLICT DO NOTHING;
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'media',
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('owner_id', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=False), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+    )
+    op.create_index(op.f('ix_media_owner_id'), 'media', ['owner_id'], unique=False)
+    op.create_table(
+        'map_media',
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('map_id', sa.String(), nullable=False),
+        sa.Column('point_id', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['key'], ['media.key'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['map_id'], ['maps.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['point_id'], ['points.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('key', 'map_id'),
+    )
+    op.create_index(op.f('ix_map_media_map_id'), 'map_media', ['map_id'], unique=False)
+    # Backfill from existing points
+    op.execute(BACKFILL_MEDIA_SQL)
+    op.execute(BACKFILL_MAP_MEDIA_SQL)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_map_media_map_id'), table_name='map_media')
+    op.drop_table('map_media')
+    op.drop_index(op.f('ix_media_owner_id'), table_name='media')
+    op.drop_table('media')
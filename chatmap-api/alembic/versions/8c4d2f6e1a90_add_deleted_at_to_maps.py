@@ -0,0 +1,80 @@
+"""Add deleted_at to maps for background deletion
+
+Revision ID: 8c4d2f6e1a90
+Revises: 3f9c1e7a2b6d
+Create Date: 2026-10-19 12:40:07.552871
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '8c4d2f6e1a90'
+down_revision: Union[str, Sequence[str], None] = '3f9c1e7a2b6d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SKIP_DELETED_MAPS_SQL = """\
+    -- If map is being deleted, skip
+    IF EXISTS (SELECT 1 FROM maps WHERE id = v_map_id AND deleted_at IS NOT NULL) THEN
+        RETURN NULL;
+    END IF;
+
+"""
+
+# Same as in 74a24da4d758, but skipping maps being deleted, so purging
+# their points doesn't recompute the centroid for every row
+CREATE_OR_REPLACE_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION update_map_centroid()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_map_id VARCHAR;
+    v_centroid GEOMETRY;
+BEGIN
+    -- IF delete, use OLD
+    IF TG_OP = 'DELETE' THEN
+        v_map_id := OLD.map_id;
+    ELSE
+        -- For INSERT and UPDATE, use NEW
+        v_map_id := NEW.map_id;
+    END IF;
+
+    -- If map_id is null, skip
+    IF v_map_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+{skip_deleted_maps}    -- Calculate the centroid
+    WITH sampled_points AS (
+        SELECT geom
+        FROM points
+        WHERE map_id = v_map_id 
+        ORDER BY random()
+        LIMIT 50
+    )
+    SELECT ST_Centroid(ST_Collect(geom)) INTO v_centroid
+    FROM sampled_points;
+
+    -- Update the maps table
+    UPDATE "maps"
+    SET centroid = v_centroid
+    WHERE id = v_map_id;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+""".replace("{skip_deleted_maps}", SKIP_DELETED_MAPS_SQL)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('maps', sa.Column('deleted_at', sa.DateTime(timezone=False), nullable=True))
+    op.execute(CREATE_OR_REPLACE_FUNCTION_SQL)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute(CREATE_OR_REPLACE_FUNCTION_SQL.replace(SKIP_DELETED_MAPS_SQL, ""))
+    op.drop_column('maps', 'deleted_at')
@@ -0,0 +1,50 @@
+"""Add media owners
+
+Revision ID: 9b4e6f2a7c13
+Revises: e2a7b5c9d431
+Create Date: 2026-10-19 16:41:07.502913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b4e6f2a7c13'
+down_revision: Union[str, Sequence[str], None] = 'e2a7b5c9d431'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Uploaders registered so far, and owners of the maps already using each file
+BACKFILL_MEDIA_OWNERS_SQL = """
+INSERT INTO media_owners (key, owner_id, created_at)
+SELECT key, owner_id, created_at FROM media
+UNION
+SELECT map_media.key, maps.owner_id, media.created_at
+FROM map_media
+JOIN maps ON maps.id = map_media.map_id
+JOIN media ON media.key = map_media.key
+ON CONFLICT DO NOTHING;
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'media_owners',
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('owner_id', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=False), nullable=False),
+        sa.ForeignKeyConstraint(['key'], ['media.key'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('key', 'owner_id'),
+    )
+    op.create_index(op.f('ix_media_owners_owner_id'), 'media_owners', ['owner_id'], unique=False)
+    op.execute(BACKFILL_MEDIA_OWNERS_SQL)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_media_owners_owner_id'), table_name='media_owners')
+    op.drop_table('media_owners')
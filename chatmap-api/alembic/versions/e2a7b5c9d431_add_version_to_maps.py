@@ -0,0 +1,80 @@
+"""Add version to maps, bumped when points change
+
+Revision ID: e2a7b5c9d431
+Revises: 8c4d2f6e1a90
+Create Date: 2026-10-19 15:03:52.114390
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a7b5c9d431'
+down_revision: Union[str, Sequence[str], None] = '8c4d2f6e1a90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BUMP_VERSION_SQL = """,
+        version = version + 1"""
+
+# Same as in 8c4d2f6e1a90, also bumping the map version (used to cache exports)
+CREATE_OR_REPLACE_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION update_map_centroid()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_map_id VARCHAR;
+    v_centroid GEOMETRY;
+BEGIN
+    -- IF delete, use OLD
+    IF TG_OP = 'DELETE' THEN
+        v_map_id := OLD.map_id;
+    ELSE
+        -- For INSERT and UPDATE, use NEW
+        v_map_id := NEW.map_id;
+    END IF;
+
+    -- If map_id is null, skip
+    IF v_map_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- If map is being deleted, skip
+    IF EXISTS (SELECT 1 FROM maps WHERE id = v_map_id AND deleted_at IS NOT NULL) THEN
+        RETURN NULL;
+    END IF;
+
+    -- Calculate the centroid
+    WITH sampled_points AS (
+        SELECT geom
+        FROM points
+        WHERE map_id = v_map_id 
+        ORDER BY random()
+        LIMIT 50
+    )
+    SELECT ST_Centroid(ST_Collect(geom)) INTO v_centroid
+    FROM sampled_points;
+
+    -- Update the maps table
+    UPDATE "maps"
+    SET centroid = v_centroid{bump_version}
+    WHERE id = v_map_id;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('maps', sa.Column('version', sa.Integer(), nullable=False, server_default=sa.text("0")))
+    op.execute(CREATE_OR_REPLACE_FUNCTION_SQL.replace("{bump_version}", BUMP_VERSION_SQL))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute(CREATE_OR_REPLACE_FUNCTION_SQL.replace("{bump_version}", ""))
+    op.drop_column('maps', 'version')
@@ -5,15 +5,27 @@ and stores the resulting map points in a database.
 """
 
 import os
+import asyncio
+import multiprocessing
 import logging
 import httpx
 import base64
 import hashlib
+from botocore.exceptions import ClientError
 from db import add_points, get_db_session
+from storage import get_s3_client, upload_fileobj, object_exists, AsyncIteratorReader, MediaTooLarge
+from derivatives import schedule_derivatives
 from Crypto.Cipher import AES
-from typing import Dict, Sequence, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Sequence, Tuple
 from chatmap_py import parser as chatmap_parser
-from settings import CHATMAP_ENC_KEY, API_VERSION, MEDIA_FOLDER, API_URL, SERVER_URL
+from chatmap_py.chatmap import ChatMap
+from settings import (
+    CHATMAP_ENC_KEY, API_VERSION, MEDIA_FOLDER, API_URL, SERVER_URL,
+    INGEST_EXECUTOR, INGEST_WORKERS, S3_BUCKET_NAME, MEDIA_CHUNK_SIZE,
+    MEDIA_MAX_UPLOAD_SIZE, MEDIA_INGEST_CONCURRENCY, MEDIA_INGEST_RETRIES,
+    MEDIA_INGEST_TIMEOUT,
+)
 
 # Logs
 logger = logging.getLogger(__name__)
@@ -21,6 +33,71 @@ logger = logging.getLogger(__name__)
 # Prefix for media files
 prefix = f"v{API_VERSION}"
 
+# Encryption key, encoded once (a GCM cipher can't be reused across nonces)
+_key = CHATMAP_ENC_KEY.encode('utf-8')
+
+# Pool for parsing and decrypting messages, created on first use
+_executor = None
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if INGEST_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(
+                max_workers=INGEST_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        else:
+            _executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+    return _executor
+
+# HTTP client for media downloads, shared by all sessions, and limit of
+# parallel downloads
+_http_client = None
+_media_semaphore = asyncio.Semaphore(MEDIA_INGEST_CONCURRENCY)
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=MEDIA_INGEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=MEDIA_INGEST_CONCURRENCY),
+        )
+    return _http_client
+
+async def close_http_client() -> None:
+    """
+    Closes the media download client. Must be called on shutdown.
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+def shutdown_ingest() -> None:
+    """
+    Shuts down the parsing pool. Must be called on shutdown.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def parse_stream_id(entry_id: str | bytes) -> Tuple[int, int]:
+    """
+    Parses a Redis stream entry ID ("<ms>-<seq>"), so IDs can be compared.
+
+    Args:
+        entry_id (str | bytes): Stream entry ID.
+
+    Returns:
+        Tuple[int, int]: Milliseconds timestamp and sequence number.
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode("utf-8")
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
 def decrypt_message(encoded_data: str) -> str:
     """
     Decrypts a base64-encoded AES-GCM encrypted message.
@@ -32,101 +109,224 @@ def decrypt_message(encoded_data: str) -> str:
         str: Decrypted plaintext message.
     """
     if encoded_data:
-        key = CHATMAP_ENC_KEY.encode('utf-8')
         raw = base64.b64decode(encoded_data)
         nonce_size = 12
         nonce = raw[:nonce_size]
         ciphertext = raw[nonce_size:]
-        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        cipher = AES.new(_key, AES.MODE_GCM, nonce=nonce)
         plaintext = cipher.decrypt_and_verify(ciphertext[:-16], ciphertext[-16:])
         return plaintext.decode('utf-8')
 
+def parse_messages(data: List[Dict[str, str]]) -> List[Dict]:
+    """
+    Parses decoded Redis stream entries into chat messages. CPU-bound,
+    so it runs in the ingestion pool.
+
+    Args:
+        data (List[Dict[str, str]]): Decoded Redis stream entries.
+
+    Returns:
+        List[Dict]: Chat messages, in the same order.
+
+    Raises:
+        Exception: If an entry can't be parsed, so the entries are not
+            acknowledged and are processed again later.
+    """
+    return [chatmap_parser.parseMessage(line) for line in data]
+
+def pair_messages(
+    messages: List[Dict],
+    since_ms: int | None = None,
+    stored: Dict[str, str] | None = None,
+) -> List[Dict]:
+    """
+    Pairs chat messages into points using ChatMap, and decrypts their
+    messages. CPU-bound, so it runs in the ingestion pool.
+
+    Args:
+        messages (List[Dict]): Chat messages (see `parse_messages`).
+        since_ms (int | None): If set, only locations sent from this time
+            (Unix ms) are returned.
+        stored (Dict[str, str] | None): Locations already stored, with the
+            ID of the message they were paired with. They are skipped
+            unless they're paired with another message now.
+
+    Returns:
+        List[Dict]: Points, with the original file name of their media and
+            the ID of the message they're paired with ("related").
+
+    Raises:
+        Exception: If the chat can't be parsed, so the entries are not
+            acknowledged and are processed again later.
+    """
+    geoJSON = ChatMap(dict(enumerate(messages)), chatmap_parser.searchLocation).pairContentAndLocations()
+
+    points = []
+    for feature in geoJSON.get('features'):
+        props = feature.get("properties")
+        # Content already paired with a location comes without properties
+        if props.get("id") is None:
+            continue
+        if since_ms is not None and parse_stream_id(props["id"])[0] < since_ms:
+            continue
+        if stored and stored.get(props["id"]) == props.get("related"):
+            continue
+        coords = feature.get("geometry").get("coordinates")
+        points.append({
+            "id": props.get("id"),
+            "geom": f"POINT({coords[0]} {coords[1]})",
+            "message": decrypt_message(props.get("message")),
+            "file": props.get("file"),
+            "time": props.get("time"),
+            "username": props.get("username"),
+            "related": props.get("related"),
+        })
+    return points
+
+def store_points(points: List[Dict], user: str) -> None:
+    db = get_db_session()
+    changed = add_points(db=db, points=points, user_id=user)
+    logger.debug(f"{changed} of {len(points)} points added or changed for user {user}")
+
 # Download and save media files
 async def download_media_file(file: str, user: str) -> str:
     """
-    Downloads a media file from the server if not already present locally,
-    and returns the public URL for accessing it.
+    Streams a media file from the IM connector server to S3, if not
+    already stored, and returns the public URL for accessing it.
+    Up to MEDIA_INGEST_CONCURRENCY files are downloaded at the same time
+    with a shared client, and failed downloads are retried with backoff.
+
+    Files downloaded to the local MEDIA_FOLDER by older versions keep
+    their URL.
 
     Args:
         file (str): Filename of the media file.
         user (str): User ID associated with the media file.
 
     Returns:
-        str: Public URL to access the media file.
-    """
-    if file:
-        file_ext = file.split('.')[-1]
-        file_name = f"{hashlib.sha256(f"{user}-{file}".encode()).hexdigest()}.{file_ext}"
-        target_file = os.path.join(MEDIA_FOLDER, file_name)
-        url = f"{API_URL}/{prefix}/media?filename={file_name}"
-        if not os.path.exists(target_file):
+        str: Public URL to access the media file, or None if it can't be
+            stored (e.g. not found, empty or too large).
+
+    Raises:
+        RuntimeError: If the download still fails after MEDIA_INGEST_RETRIES
+            retries, so the entries are not acknowledged and are processed
+            again later.
+    """
+    if not file:
+        logger.debug(f'No file')
+        return None
+
+    file_ext = file.split('.')[-1]
+    file_name = f"{hashlib.sha256(f"{user}-{file}".encode()).hexdigest()}.{file_ext}"
+    target_file = os.path.join(MEDIA_FOLDER, file_name)
+    if await asyncio.to_thread(os.path.exists, target_file):
+        logger.info(f'File exists: {target_file}')
+        return f"{API_URL}/{prefix}/media?filename={file_name}"
+
+    url = f"{API_URL}/{prefix}/media/{file_name}"
+    s3 = get_s3_client()
+    async with _media_semaphore:
+        if await object_exists(s3, file_name):
+            logger.debug(f'File exists: {file_name}')
+            return url
+    error = None
+    for attempt in range(MEDIA_INGEST_RETRIES + 1):
+        if attempt:
+            # Back off without holding a download slot
+            await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+        async with _media_semaphore:
             try:
-                # Download file from IM connector server
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(f'{SERVER_URL}/media/{file}?user={user}')
+                # Stream file from IM connector server to S3
+                async with _get_http_client().stream(
+                    "GET", f'{SERVER_URL}/media/{file}?user={user}'
+                ) as response:
                     response.raise_for_status()  # Raise for 4xx/5xx
-                # Save file
-                if len(response.content) > 0:
-                    with open(target_file, "wb") as f:
-                        f.write(response.content)
-                        logger.debug(f'File saved: {target_file}')
-                else:
-                    logger.warning(f'File is empty: {file}')
-
-            except httpx.HTTPError as e:
-                logger.error(f"Failed to download: {str(e)}")
-        else:
-            logger.info(f'File exists: {target_file}')
-        return url
-    else:
-        logger.debug(f'No file')
-    return None
+                    size = await upload_fileobj(
+                        s3, file_name,
+                        AsyncIteratorReader(response.aiter_bytes(MEDIA_CHUNK_SIZE)),
+                        content_type=response.headers.get("content-type"),
+                        max_size=MEDIA_MAX_UPLOAD_SIZE,
+                    )
+                if size > 0:
+                    logger.debug(f'File saved: {file_name}')
+                    schedule_derivatives(s3, file_name)
+                    return url
+                logger.warning(f'File is empty: {file}')
+                await s3.delete_object(Bucket=S3_BUCKET_NAME, Key=file_name)
+                return None
+            except MediaTooLarge:
+                logger.error(f"File too large: {file}")
+                return None
+            except httpx.HTTPStatusError as e:
+                # Client errors (e.g. media not found) won't succeed on retry
+                if e.response.status_code < 500:
+                    logger.error(f"Failed to download: {str(e)}")
+                    return None
+                error = e
+            except (httpx.HTTPError, ClientError) as e:
+                error = e
+    raise RuntimeError(f"Failed to download {file}: {error}")
 
-async def process_chat_entries(
-    user: str,
-    entries: Sequence[Tuple[str, Dict[str, bytes]]]
-) -> None:
+async def parse_chat_entries(entries: Sequence[Tuple[str, Dict[str, bytes]]]) -> List[Dict]:
     """
-    Processes a batch of chat entries from Redis, extracts geolocation data,
-    decrypts messages, downloads media, and stores the points in the database.
+    Parses chat entries from Redis into chat messages, off the event loop.
 
     Args:
-        user (str): Identifier for the user whose chat entries are being processed.
         entries (Sequence[Tuple[str, Dict[str, bytes]]]): List of Redis stream entries,
             each entry is a tuple of (entry_id, fields).
-    """
-    logger.debug(f'process_chat_entries: session {user}')
-    db = get_db_session()
 
+    Returns:
+        List[Dict]: Chat messages, in the same order.
+    """
     # Convert Redis entries to indexed list of dictionaries
     data = [{ **{bytes.decode(k): bytes.decode(v) \
         if isinstance(v, bytes) else v for k, v in entry[1].items()}} for (_, entry) in enumerate(entries)]
 
-    # Parse chat data into GeoJSON format using ChatMap
-    geoJSON = {}
-    try:
-        geoJSON = chatmap_parser.streamParser(data)
-    except Exception as e:
-        print(f"Error parsing chat: {e}")
+    if not data:
+        return []
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), parse_messages, data)
 
-    # Create Points from Features in GeoJSON
-    points = []
-    for feature in geoJSON.get('features'):
-        logging.debug("Processing feature ...")
-        coords = feature.get("geometry").get("coordinates")
-        props = feature.get("properties")
-        geom = f"POINT({coords[0]} {coords[1]})"
-        message = decrypt_message(props.get("message"))
-        file = await download_media_file(props.get("file"), user)
-        if props.get("id") is not None:
-            logger.debug(f"Adding point id {props.get("id")}")
-            points.append({
-                "id": props.get("id"),
-                "geom": geom,
-                "message": message,
-                "file": file,
-                "time": props.get("time"),
-                "username": props.get("username"),
-            })
+async def process_chat_entries(
+    user: str,
+    messages: List[Dict],
+    since_ms: int | None = None,
+    stored: Dict[str, str] | None = None,
+) -> Dict[str, str]:
+    """
+    Processes chat messages of a session, pairs locations with their
+    content, decrypts messages, downloads media, and stores the points in
+    the database.
+
+    Args:
+        user (str): Identifier for the user whose chat entries are being processed.
+        messages (List[Dict]): Chat messages (see `parse_chat_entries`).
+        since_ms (int | None): If set, only locations sent from this time
+            (Unix ms) are stored. Older messages are only used for pairing.
+        stored (Dict[str, str] | None): Locations already stored, with the
+            ID of the message they were paired with, which are skipped if
+            their pairing didn't change.
+
+    Returns:
+        Dict[str, str]: Locations stored, with the ID of the message they
+            were paired with (without the ones whose media is missing, so
+            they're stored again next time).
+    """
+    logger.debug(f'process_chat_entries: session {user}')
+
+    # Pair chat messages and decrypt them off the event loop
+    loop = asyncio.get_running_loop()
+    points = await loop.run_in_executor(_get_executor(), pair_messages, messages, since_ms, stored)
+
+    # Download media files concurrently
+    files = await asyncio.gather(*(download_media_file(point["file"], user) for point in points))
+    paired = {}
+    for point, file in zip(points, files):
+        logger.debug(f"Adding point id {point['id']}")
+        related = point.pop("related")
+        if file or not point["file"]:
+            paired[point["id"]] = related
+        point["file"] = file
     if len(points) > 0:
-        add_points(db=db, points=points, user_id=user)
+        await asyncio.to_thread(store_points, points, user)
+    return paired
@@ -5,6 +5,7 @@ and utility functions for handling map and point data. It supports:
 - Creating or retrieving user-specific maps
 - Storing geographic points with associated metadata
 - Handling duplicate points via upsert logic
+- Registering media objects and the maps that reference them
 - Generating GeoJSON representations of maps
 """
 
@@ -13,13 +14,16 @@ import logging
 from enum import Enum
 from sqlalchemy import (
     create_engine, Column, String, select, DateTime, ForeignKey, func,
-    Enum as SqlEnum, Boolean,
+    Enum as SqlEnum, Boolean, Integer, or_, exists,
 )
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.pool import NullPool
-from sqlalchemy.orm import sessionmaker, declarative_base, Session, relationship
+from sqlalchemy.orm import sessionmaker, declarative_base, Session, relationship, aliased
 from geoalchemy2 import Geometry
-from settings import CHATMAP_DB, CHATMAP_DB_USER, CHATMAP_DB_PASSWORD, CHATMAP_DB_PORT, CHATMAP_DB_HOST
+from settings import (
+    CHATMAP_DB, CHATMAP_DB_USER, CHATMAP_DB_PASSWORD, CHATMAP_DB_PORT, CHATMAP_DB_HOST,
+    CHATMAP_DB_REPLICA_HOST, CHATMAP_DB_REPLICA_PORT,
+)
 from datetime import datetime
 
 # Logs
@@ -31,6 +35,12 @@ DATABASE_URL = (
     f"@{CHATMAP_DB_HOST}:{CHATMAP_DB_PORT}/{CHATMAP_DB}"
 )
 
+# Read replica connection string (optional)
+REPLICA_DATABASE_URL = (
+    f"postgresql://{CHATMAP_DB_USER}:{CHATMAP_DB_PASSWORD}"
+    f"@{CHATMAP_DB_REPLICA_HOST}:{CHATMAP_DB_REPLICA_PORT}/{CHATMAP_DB}"
+) if CHATMAP_DB_REPLICA_HOST else None
+
 # SQLAlchemy engine
 engine = create_engine(
     DATABASE_URL,
@@ -38,6 +48,13 @@ engine = create_engine(
     poolclass=NullPool
 )
 
+# SQLAlchemy engine for read-only queries (primary if no replica is set)
+replica_engine = create_engine(
+    REPLICA_DATABASE_URL,
+    echo=False,
+    poolclass=NullPool
+) if REPLICA_DATABASE_URL else engine
+
 # Base class for all SQLAlchemy models
 Base = declarative_base()
 
@@ -48,6 +65,13 @@ SessionLocal = sessionmaker(
     bind=engine,
 )
 
+# Session factory for read-only database operations
+ReplicaSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    bind=replica_engine,
+)
+
 # Enum for sharing permissions of a map
 class SharePermission(str, Enum):
     PRIVATE = "private"
@@ -70,6 +94,9 @@ class Map(Base):
     updated_at = Column(DateTime(timezone=False), default=datetime.now, nullable=False)
     is_live = Column(Boolean, default=False, nullable=False)
     centroid = Column(Geometry(geometry_type="POINT", srid=4326), nullable=True, default=None)
+    deleted_at = Column(DateTime(timezone=False), nullable=True, default=None)
+    # Bumped by a trigger every time the map points change
+    version = Column(Integer, nullable=False, default=0, server_default="0")
 
     # Relationship to Point model
     points = relationship(
@@ -91,7 +118,7 @@ def get_or_create_live_map(db, user_id: str) -> str:
         str: The ID of the map associated with the user
     """
     with db.begin():
-        stmt = select(Map.id).where(Map.owner_id == user_id, Map.is_live)
+        stmt = select(Map.id).where(Map.owner_id == user_id, Map.is_live, Map.deleted_at.is_(None))
         map_id = db.execute(stmt).scalar_one_or_none()
 
         if map_id:
@@ -105,6 +132,22 @@ def get_or_create_live_map(db, user_id: str) -> str:
 
         return new_map.id
 
+def get_active_map(db: Session, map_id: str) -> Map | None:
+    """
+    Retrieves a map by ID, ignoring maps marked for deletion.
+
+    Args:
+        db (Session): SQLAlchemy database session
+        map_id (str): ID of the map
+
+    Returns:
+        Map: The map, or None if it doesn't exist or is being deleted
+    """
+    map_obj = db.get(Map, map_id)
+    if map_obj is None or map_obj.deleted_at is not None:
+        return None
+    return map_obj
+
 # Model representing a geographic point in a map
 class Point(Base):
     __tablename__ = "points"
@@ -121,16 +164,195 @@ class Point(Base):
     map    = relationship("Map", back_populates="points")
 
 
+# Model representing a media object stored in the bucket
+class Media(Base):
+    __tablename__ = "media"
+    key = Column(String, primary_key=True)
+    owner_id = Column(String, nullable=False, index=True)
+    created_at = Column(DateTime(timezone=False), default=datetime.now, nullable=False)
+
+
+# Model representing the users who uploaded a media object. Media is
+# content-addressed, so the same object can be uploaded by several users
+class MediaOwner(Base):
+    __tablename__ = "media_owners"
+    key = Column(String, ForeignKey("media.key", ondelete="CASCADE"), primary_key=True)
+    owner_id = Column(String, primary_key=True, index=True)
+    created_at = Column(DateTime(timezone=False), default=datetime.now, nullable=False)
+
+
+# Model linking a media object with the maps (and points) using it
+class MapMedia(Base):
+    __tablename__ = "map_media"
+    key = Column(String, ForeignKey("media.key", ondelete="CASCADE"), primary_key=True)
+    map_id = Column(String, ForeignKey("maps.id", ondelete="CASCADE"), primary_key=True, index=True)
+    point_id = Column(String, ForeignKey("points.id", ondelete="SET NULL"), nullable=True)
+
+
+def media_key(file: str) -> str | None:
+    """
+    Extracts the object key from a media URL, supporting both
+    `.../media/<key>` and `.../media?filename=<key>` URLs.
+
+    Args:
+        file (str): Media URL as stored in Point.file
+
+    Returns:
+        str: The media key, or None if there's no file
+    """
+    if not file:
+        return None
+    return file.replace("media?filename=", "/").rsplit("/", 1)[-1]
+
+
+def register_media(db: Session, key: str, owner_id: str) -> None:
+    """
+    Registers a media object uploaded by a user. The object is kept
+    registered to every user who uploaded it, with the time of their
+    last upload.
+
+    Args:
+        db (Session): SQLAlchemy database session
+        key (str): Object key of the media file
+        owner_id (str): ID of the user who uploaded the file
+    """
+    now = datetime.now()
+    stmt = insert(Media).values(key=key, owner_id=owner_id, created_at=now)
+    db.execute(stmt.on_conflict_do_nothing(index_elements=["key"]))
+    stmt = insert(MediaOwner).values(key=key, owner_id=owner_id, created_at=now)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["key", "owner_id"],
+        set_={"created_at": stmt.excluded.created_at},
+    ))
+
+
+def link_media(db: Session, map_id: str, owner_id: str, points) -> None:
+    """
+    Links the media files of a batch of points to a map, registering
+    unknown media files as owned by the map owner. Media files not
+    uploaded by the map owner aren't linked, so they can't be exposed
+    through the map.
+    Doesn't commit, so it can be part of the caller's transaction.
+
+    Args:
+        db (Session): SQLAlchemy database session
+        map_id (str): ID of the map the points belong to
+        owner_id (str): ID of the map owner
+        points (List[Dict]): List of point dictionaries with 'id' and 'file' keys
+    """
+    links = {}
+    for pt in points:
+        key = media_key(pt.get("file"))
+        if key and key not in links:
+            links[key] = {"key": key, "map_id": map_id, "point_id": pt.get("id")}
+    if not links:
+        return
+    now = datetime.now()
+    stmt = insert(Media).values([
+        {"key": key, "owner_id": owner_id, "created_at": now} for key in links
+    ])
+    new_keys = db.execute(
+        stmt.on_conflict_do_nothing(index_elements=["key"]).returning(Media.key)
+    ).scalars().all()
+    if new_keys:
+        stmt = insert(MediaOwner).values([
+            {"key": key, "owner_id": owner_id, "created_at": now} for key in new_keys
+        ])
+        db.execute(stmt.on_conflict_do_nothing(index_elements=["key", "owner_id"]))
+    owned = set(db.execute(
+        select(MediaOwner.key).where(MediaOwner.key.in_(links), MediaOwner.owner_id == owner_id)
+    ).scalars())
+    foreign = [key for key in links if key not in owned]
+    for key in foreign:
+        del links[key]
+    if foreign:
+        logger.warning(f"Not linking {len(foreign)} media files owned by other users to map {map_id}")
+    if not links:
+        return
+    stmt = insert(MapMedia).values(list(links.values()))
+    db.execute(stmt.on_conflict_do_nothing(index_elements=["key", "map_id"]))
+
+
+def unreferenced_media_keys(db: Session, map_id: str, limit: int | None = None) -> list[str]:
+    """
+    Returns the media keys used by a map that nothing else references,
+    so their objects can be safely deleted along with the map.
+    Media files are content-addressed, so the same object can be shared
+    by several maps: the map_media rows act as its reference count.
+    Uploads not linked to a map yet also count as references: files
+    uploaded by other users, or uploaded again by the map owner after
+    the map was deleted, are kept.
+
+    Args:
+        db (Session): SQLAlchemy database session
+        map_id (str): ID of the map
+        limit (int): Max number of keys to return (optional)
+
+    Returns:
+        List[str]: Media keys only referenced by the map
+    """
+    other = aliased(MapMedia)
+    stmt = (
+        select(MapMedia.key)
+            .join(Map, Map.id == MapMedia.map_id)
+            .where(MapMedia.map_id == map_id)
+            .where(~exists().where(other.key == MapMedia.key, other.map_id != map_id))
+            .where(~exists().where(
+                MediaOwner.key == MapMedia.key,
+                or_(MediaOwner.owner_id != Map.owner_id, MediaOwner.created_at >= Map.deleted_at),
+            ))
+            .limit(limit)
+    )
+    return list(db.execute(stmt).scalars())
+
+
+def get_media_access(db: Session, key: str, user_id: str | None = None) -> SharePermission | None:
+    """
+    Checks if a media file can be accessed by a user.
+
+    Args:
+        db (Session): SQLAlchemy database session
+        key (str): Object key of the media file
+        user_id (str): ID of the current user (optional)
+
+    Returns:
+        SharePermission: PUBLIC if the media is used in a public map,
+            PRIVATE if only the user can access it, None if not accessible.
+    """
+    media = db.get(Media, key)
+    if media is None:
+        return None
+    map_filter = Map.sharing == SharePermission.PUBLIC
+    if user_id:
+        map_filter = or_(map_filter, Map.owner_id == user_id)
+    map_filter = map_filter & Map.deleted_at.is_(None)
+    sharing = db.execute(
+        select(Map.sharing)
+            .join(MapMedia, MapMedia.map_id == Map.id)
+            .where(MapMedia.key == key, map_filter)
+    ).scalars().all()
+    if SharePermission.PUBLIC in sharing:
+        return SharePermission.PUBLIC
+    if sharing or (user_id and db.get(MediaOwner, (key, user_id)) is not None):
+        return SharePermission.PRIVATE
+    return None
+
+
 # Insert or update multiple points for a user
 def add_points(db: Session, points, user_id):
     """
     Adds or updates a batch of geographic points for a user's map.
-    Uses PostgreSQL's ON CONFLICT DO UPDATE to handle duplicates.
+    Uses PostgreSQL's ON CONFLICT DO UPDATE to handle duplicates, skipping
+    points whose content didn't change, so unchanged rows aren't rewritten
+    (and the centroid trigger doesn't run for them).
 
     Args:
         db (Session): SQLAlchemy database session
         points (List[Dict]): List of point dictionaries with keys like 'id', 'geom', 'message', etc.
         user_id (str): ID of the user who owns the points
+
+    Returns:
+        int: Number of points inserted or updated
     """
     map_id = get_or_create_live_map(db, user_id)
     for pt in points:
@@ -145,10 +367,17 @@ def add_points(db: Session, points, user_id):
     }
     stmt = stmt.on_conflict_do_update(
         index_elements=["id"],
-        set_=update_dict
-    )
-    db.execute(stmt)
+        set_=update_dict,
+        where=or_(*[
+            getattr(Point, column).is_distinct_from(value)
+            for column, value in update_dict.items()
+        ]),
+    ).returning(Point.id)
+    changed = set(db.execute(stmt).scalars())
+    if changed:
+        link_media(db, map_id, user_id, [pt for pt in points if pt["id"] in changed])
     db.commit()
+    return len(changed)
 
 
 # Dependency to get a database session
@@ -164,3 +393,19 @@ def get_db_session():
         return db
     finally:
         db.close()
+
+
+# Dependency to get a read-only database session
+def get_replica_db_session():
+    """
+    Provides a database session bound to the read replica, if configured.
+    Must only be used for queries, writes should use `get_db_session`.
+
+    Yields:
+        Session: SQLAlchemy database session
+    """
+    db = ReplicaSessionLocal()
+    try:
+        return db
+    finally:
+        db.close()
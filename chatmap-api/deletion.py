@@ -0,0 +1,161 @@
+"""
+This module deletes maps in the background. Deleting a map only marks it
+as deleted, then `purge_map` removes its media objects with batched S3
+DeleteObjects calls and its points with set-based SQL, in small
+transactions. Every step is idempotent, so interrupted purges are safely
+retried by `purge_deleted_maps`, which runs periodically.
+"""
+
+import asyncio
+import logging
+from sqlalchemy import select, delete, func, text
+from db import engine, Map, Media, MapMedia, Point, unreferenced_media_keys
+from derivatives import is_image, derivative_key, DERIVATIVE_SIZES
+from settings import (
+    S3_BUCKET_NAME, MAP_PURGE_MEDIA_BATCH, MAP_PURGE_POINTS_BATCH, EXPORT_CACHE_PREFIX,
+)
+
+# Logs
+logger = logging.getLogger(__name__)
+
+# Max number of keys per DeleteObjects call
+S3_DELETE_MAX_KEYS = 1000
+
+DELETE_POINTS_BATCH_SQL = text("""
+DELETE FROM points
+WHERE id IN (
+    SELECT id FROM points WHERE map_id = :map_id LIMIT :limit
+)
+""")
+
+def deletion_progress(db, map_id: str) -> dict:
+    """
+    Returns the remaining points and media files of a map being deleted.
+
+    Args:
+        db (Session): SQLAlchemy database session
+        map_id (str): ID of the map
+
+    Returns:
+        dict: Remaining points and media links
+    """
+    return {
+        "points": db.execute(
+            select(func.count(Point.id)).where(Point.map_id == map_id)
+        ).scalar_one(),
+        "media": db.execute(
+            select(func.count()).select_from(MapMedia).where(MapMedia.map_id == map_id)
+        ).scalar_one(),
+    }
+
+def _try_lock(conn, lock_id) -> bool:
+    return conn.execute(select(func.pg_try_advisory_lock(lock_id.scalar_subquery()))).scalar()
+
+def _unlock(conn, lock_id) -> None:
+    conn.rollback()
+    conn.execute(select(func.pg_advisory_unlock(lock_id.scalar_subquery())))
+    conn.commit()
+
+def _get_deleted_at(conn, map_id: str):
+    return conn.execute(select(Map.deleted_at).where(Map.id == map_id)).scalar()
+
+def _delete_media_rows(conn, keys: list[str]) -> None:
+    conn.execute(delete(Media).where(Media.key.in_(keys)))
+    conn.commit()
+
+def _delete_map_media(conn, map_id: str) -> None:
+    conn.execute(delete(MapMedia).where(MapMedia.map_id == map_id))
+    conn.commit()
+
+def _delete_points_batch(conn, map_id: str) -> int:
+    count = conn.execute(
+        DELETE_POINTS_BATCH_SQL,
+        {"map_id": map_id, "limit": MAP_PURGE_POINTS_BATCH},
+    ).rowcount
+    conn.commit()
+    return count
+
+def _delete_map(conn, map_id: str) -> None:
+    conn.execute(delete(Map).where(Map.id == map_id))
+    conn.commit()
+
+async def purge_map(map_id: str, s3) -> None:
+    """
+    Removes the media, points and row of a map marked as deleted.
+    A Postgres advisory lock ensures only one worker purges a map at a time.
+    Database calls are blocking, so each step runs in a worker thread.
+
+    Args:
+        map_id (str): ID of the map
+        s3: S3 client.
+    """
+    conn = await asyncio.to_thread(engine.connect)
+    try:
+        lock_id = select(func.hashtext(map_id))
+        if not await asyncio.to_thread(_try_lock, conn, lock_id):
+            logger.debug(f'purge_map: map {map_id} already being purged')
+            return
+        try:
+            if await asyncio.to_thread(_get_deleted_at, conn, map_id) is None:
+                return
+
+            # Delete media objects (and their derivatives) only used by this map
+            while keys := await asyncio.to_thread(
+                unreferenced_media_keys, conn, map_id, MAP_PURGE_MEDIA_BATCH,
+            ):
+                objects = [{'Key': key} for key in keys] + [
+                    {'Key': derivative_key(key, size)}
+                    for key in keys if is_image(key)
+                    for size in DERIVATIVE_SIZES
+                ]
+                for i in range(0, len(objects), S3_DELETE_MAX_KEYS):
+                    resp = await s3.delete_objects(
+                        Bucket=S3_BUCKET_NAME,
+                        Delete={'Objects': objects[i:i + S3_DELETE_MAX_KEYS], 'Quiet': True},
+                    )
+                    errors = resp.get('Errors', [])
+                    if errors:
+                        raise RuntimeError(f"Failed to delete {len(errors)} media files: {errors[0]}")
+                await asyncio.to_thread(_delete_media_rows, conn, keys)
+                logger.debug(f'purge_map: {len(keys)} media files deleted from map {map_id}')
+
+            # Delete cached exports
+            paginator = s3.get_paginator('list_objects_v2')
+            async for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=f"{EXPORT_CACHE_PREFIX}/{map_id}/"):
+                objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+                if objects:
+                    await s3.delete_objects(Bucket=S3_BUCKET_NAME, Delete={'Objects': objects, 'Quiet': True})
+
+            # Unlink media shared with other maps
+            await asyncio.to_thread(_delete_map_media, conn, map_id)
+
+            # Delete points in batches
+            while count := await asyncio.to_thread(_delete_points_batch, conn, map_id):
+                logger.debug(f'purge_map: {count} points deleted from map {map_id}')
+
+            await asyncio.to_thread(_delete_map, conn, map_id)
+            logger.info(f'purge_map: map {map_id} deleted')
+        finally:
+            await asyncio.to_thread(_unlock, conn, lock_id)
+    finally:
+        await asyncio.to_thread(conn.close)
+
+def _get_deleted_map_ids() -> list[str]:
+    with engine.connect() as conn:
+        return conn.execute(
+            select(Map.id).where(Map.deleted_at.is_not(None))
+        ).scalars().all()
+
+async def purge_deleted_maps(s3) -> None:
+    """
+    Purges all maps marked as deleted, retrying interrupted purges.
+
+    Args:
+        s3: S3 client.
+    """
+    map_ids = await asyncio.to_thread(_get_deleted_map_ids)
+    for map_id in map_ids:
+        try:
+            await purge_map(map_id, s3)
+        except Exception as e:
+            logger.error(f'purge_deleted_maps: failed to purge map {map_id}: {e}')
@@ -0,0 +1,197 @@
+"""
+This module generates image derivatives (thumbnails and previews) for
+media files, so maps don't need to load full resolution images.
+
+Derivatives are stored in the media bucket next to the originals and
+generated in a process pool, off the event loop. They are created when
+media is uploaded or ingested, or lazily the first time they're requested.
+"""
+
+import io
+import os
+import asyncio
+import logging
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from botocore.exceptions import ClientError
+from settings import (
+    S3_BUCKET_NAME, MEDIA_FOLDER, MEDIA_DERIVATIVES, MEDIA_DERIVATIVE_FORMAT,
+    MEDIA_DERIVATIVE_PREFIX, MEDIA_DERIVATIVE_WORKERS,
+)
+
+# Logs
+logger = logging.getLogger(__name__)
+
+# Max width/height (in pixels) for each derivative size
+DERIVATIVE_SIZES = {
+    "thumb": 256,
+    "medium": 1024,
+}
+
+# Images that derivatives can be generated for
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+# Pillow format and extension for derivatives
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+}
+FORMAT, EXTENSION, CONTENT_TYPE = DERIVATIVE_FORMATS.get(MEDIA_DERIVATIVE_FORMAT, DERIVATIVE_FORMATS["webp"])
+
+# Process pool, created on first use
+_executor = None
+
+# Keep references to running tasks
+_tasks = set()
+
+# Lazy generations in progress (key -> future)
+_inflight = {}
+
+def is_image(key: str) -> bool:
+    return Path(key).suffix.lower() in IMAGE_EXTENSIONS
+
+def derivative_key(key: str, size: str) -> str:
+    """
+    Returns the object key of a derivative.
+
+    Args:
+        key (str): Object key of the original media file
+        size (str): Derivative size (thumb, medium)
+
+    Returns:
+        str: Object key of the derivative
+    """
+    return f"{MEDIA_DERIVATIVE_PREFIX}/{size}/{Path(key).stem}{EXTENSION}"
+
+def _resize(data: bytes, sizes: dict, format: str) -> dict:
+    # Runs in a worker process
+    from PIL import Image, ImageOps
+    results = {}
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if format == "JPEG" or image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        for size, max_px in sizes.items():
+            derivative = image.copy()
+            derivative.thumbnail((max_px, max_px))
+            output = io.BytesIO()
+            derivative.save(output, format=format, quality=80)
+            results[size] = output.getvalue()
+    return results
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Workers are spawned, as forking the API process would copy its
+        # event loop, threads and open connections
+        _executor = ProcessPoolExecutor(
+            max_workers=MEDIA_DERIVATIVE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+def shutdown_derivatives() -> None:
+    """
+    Shuts down the process pool. Must be called on shutdown.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+async def _read_original(s3, key: str) -> bytes | None:
+    try:
+        resp = await s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+        async with resp["Body"] as body:
+            return await body.read()
+    except ClientError:
+        pass
+    # Files from the legacy ingestion are in the media folder
+    path = os.path.join(MEDIA_FOLDER, key)
+    if os.path.isfile(path):
+        return await asyncio.to_thread(Path(path).read_bytes)
+    return None
+
+async def create_derivatives(s3, key: str, data: bytes | None = None) -> dict:
+    """
+    Generates and stores all derivatives for an image.
+
+    Args:
+        s3: S3 client.
+        key (str): Object key of the original image
+        data (bytes): Content of the original image (fetched if not provided)
+
+    Returns:
+        Dict[str, bytes]: Derivative content by size (empty if not an image)
+    """
+    if not is_image(key):
+        return {}
+    if data is None:
+        data = await _read_original(s3, key)
+        if data is None:
+            return {}
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(_get_executor(), _resize, data, DERIVATIVE_SIZES, FORMAT)
+    await asyncio.gather(*[
+        s3.put_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=derivative_key(key, size),
+            Body=content,
+            ContentType=CONTENT_TYPE,
+        )
+        for size, content in results.items()
+    ])
+    logger.debug(f'Derivatives created for {key}')
+    return results
+
+async def ensure_derivatives(s3, key: str) -> dict:
+    """
+    Generates the derivatives of an image requested before they were
+    created. Concurrent requests for the same image wait for a single
+    generation instead of generating them several times.
+
+    Args:
+        s3: S3 client.
+        key (str): Object key of the original image
+
+    Returns:
+        Dict[str, bytes]: Derivative content by size (empty if they
+            couldn't be generated)
+    """
+    if key in _inflight:
+        return await asyncio.shield(_inflight[key])
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    results = {}
+    try:
+        results = await create_derivatives(s3, key)
+    except Exception as e:
+        logger.error(f'Failed to create derivatives for {key}: {e}')
+    finally:
+        future.set_result(results)
+        del _inflight[key]
+    return results
+
+def schedule_derivatives(s3, key: str, data: bytes | None = None) -> None:
+    """
+    Generates derivatives for an image in the background, if enabled.
+
+    Args:
+        s3: S3 client.
+        key (str): Object key of the original image
+        data (bytes): Content of the original image (optional)
+    """
+    if not MEDIA_DERIVATIVES or not is_image(key):
+        return
+
+    async def run():
+        try:
+            await create_derivatives(s3, key, data)
+        except Exception as e:
+            logger.error(f'Failed to create derivatives for {key}: {e}')
+
+    task = asyncio.create_task(run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
@@ -4,6 +4,9 @@ set -eo pipefail
 # run app
 if [[ -z "$@" ]]; then
     exec uv run uvicorn main:app --host 0.0.0.0 --port 8000 --log-level warning
+# run ingestion worker
+elif [[ "$1" == "worker" ]]; then
+    exec uv run python worker.py
 else
     exec $@
 fi
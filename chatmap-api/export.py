@@ -0,0 +1,336 @@
+"""
+This module builds map exports (Zip with GeoJSON or CSV and media files)
+as a stream, so the download starts right away and memory stays bounded
+regardless of the size of the map.
+
+Media files are read directly from the object store, several at a time.
+Small files are prefetched in memory while larger ones (e.g. videos) are
+streamed into the Zip in chunks.
+
+Exports can also run as background jobs, storing the resulting Zip in the
+object store keyed by map version, so it's reused until the map changes.
+"""
+
+import io
+import os
+import time
+import hashlib
+import asyncio
+import logging
+import zipfile
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable
+from botocore.exceptions import ClientError
+from db import Map, media_key
+from stream import redis_client
+from storage import upload_fileobj, AsyncIteratorReader
+from settings import (
+    S3_BUCKET_NAME, MEDIA_FOLDER, MEDIA_CHUNK_SIZE, EXPORT_PREFETCH,
+    EXPORT_PREFETCH_MAX_SIZE, EXPORT_CACHE_PREFIX, EXPORT_JOB_TTL, EXPORT_JOB_LOCK_TTL,
+)
+
+# Logs
+logger = logging.getLogger(__name__)
+
+# Media formats that are already compressed, stored without deflate
+COMPRESSED_EXTENSIONS = {
+    "jpg", "jpeg", "png", "webp", "gif", "mp4", "mov", "webm",
+    "opus", "ogg", "mp3", "m4a",
+}
+
+class ZipStream(io.RawIOBase):
+    """
+    Non-seekable file object collecting the bytes written by ZipFile,
+    so they can be yielded as they are produced.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+        return len(b)
+
+    def pop(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+async def fetch_media(s3, file: str):
+    """
+    Fetches a media file for the export, from the local media folder
+    (legacy files) or the object store.
+
+    Args:
+        s3: S3 client.
+        file (str): Media file URL.
+
+    Returns:
+        Tuple: (size, content) for prefetched files or (size, body) for
+            streamed ones, None if the file can't be found.
+    """
+    key = media_key(file)
+    if "media?filename=" in file:
+        path = os.path.join(MEDIA_FOLDER, key)
+        if not os.path.isfile(path):
+            return None
+        return os.path.getsize(path), await asyncio.to_thread(_read_file, path)
+    try:
+        resp = await s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+    except ClientError as e:
+        logger.error(f"Failed to get media {key}: {e}")
+        return None
+    size = resp["ContentLength"]
+    if size <= EXPORT_PREFETCH_MAX_SIZE:
+        async with resp["Body"] as body:
+            return size, await body.read()
+    return size, resp["Body"]
+
+def close_media(media) -> None:
+    """
+    Releases the connection of a streamed media file that won't be read.
+
+    Args:
+        media (Tuple): Result of `fetch_media`
+    """
+    if media is not None and not isinstance(media[1], bytes):
+        media[1].close()
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+async def stream_export(
+    features,
+    s3,
+    write_map: Callable[[zipfile.ZipFile], None],
+    on_progress: Callable[[int, int], Awaitable[None]] | None = None,
+) -> AsyncIterator[bytes]:
+    """
+    Streams a Zip file with the media of a map, followed by the map data.
+    Feature properties are updated with the file name inside the Zip
+    (and the original URL in `file_url`) before `write_map` is called.
+
+    Args:
+        features (List[Dict]): GeoJSON features of the map.
+        s3: S3 client.
+        write_map (Callable): Writes the map data (GeoJSON, CSV) to the Zip.
+        on_progress (Callable): Awaited with (processed, total) media files (optional)
+
+    Yields:
+        bytes: Zip file content
+    """
+    out = ZipStream()
+    zf = zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED)
+    files = deque(feature for feature in features if feature['properties']['file'])
+    total = len(files)
+    pending = deque()
+    written = set()
+
+    try:
+        while files or pending:
+            # Keep up to EXPORT_PREFETCH downloads in flight
+            while files and len(pending) < EXPORT_PREFETCH:
+                feature = files.popleft()
+                pending.append((feature, asyncio.create_task(fetch_media(s3, feature['properties']['file']))))
+            feature, task = pending.popleft()
+            if on_progress:
+                await on_progress(total - len(files) - len(pending), total)
+            try:
+                media = await task
+            except Exception as e:
+                logger.error(f"Failed to download: {str(e)}")
+                continue
+            if media is None:
+                continue
+
+            # Update file properties
+            filename = media_key(feature['properties']['file'])
+            feature['properties']['file_url'] = feature['properties']['file']
+            feature['properties']['file'] = filename
+            if filename in written:
+                close_media(media)
+                continue
+            written.add(filename)
+
+            # Add file to zip
+            size, content = media
+            zinfo = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+            zinfo.file_size = size
+            ext = filename.rsplit(".", 1)[-1].lower()
+            zinfo.compress_type = zipfile.ZIP_STORED if ext in COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with zf.open(zinfo, "w") as entry:
+                if isinstance(content, bytes):
+                    entry.write(content)
+                else:
+                    async with content as body:
+                        async for chunk in body.iter_chunks(MEDIA_CHUNK_SIZE):
+                            entry.write(chunk)
+                            yield out.pop()
+            yield out.pop()
+    finally:
+        # Stop downloads if the client went away, and release the
+        # connections of files already fetched but not read
+        for _, task in pending:
+            task.cancel()
+        results = await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+        for media in results:
+            if isinstance(media, tuple):
+                close_media(media)
+
+    write_map(zf)
+    zf.close()
+    yield out.pop()
+
+
+# Redis key prefix for export jobs
+EXPORT_JOB_KEY = "export_job"
+
+def export_version(map_obj: Map) -> str:
+    """
+    Returns a version identifier for a map export, which changes every
+    time the map points or metadata change.
+
+    Args:
+        map_obj (Map): The map
+
+    Returns:
+        str: Version identifier
+    """
+    data = f"{map_obj.version}:{map_obj.name}:{map_obj.description}:{map_obj.sharing.value}"
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+def export_key(map_id: str, version: str, format: str) -> str:
+    """
+    Returns the object key of a cached export.
+
+    Args:
+        map_id (str): ID of the map
+        version (str): Export version (see `export_version`)
+        format (str): Export format (geojson, csv)
+
+    Returns:
+        str: Object key
+    """
+    return f"{EXPORT_CACHE_PREFIX}/{map_id}/{version}.{format}.zip"
+
+async def get_export_job(map_id: str, format: str) -> dict:
+    """
+    Returns the status of the last export job for a map. Running jobs
+    whose lock expired (e.g. the worker crashed) are reported as failed,
+    so they can be started again.
+
+    Args:
+        map_id (str): ID of the map
+        format (str): Export format (geojson, csv)
+
+    Returns:
+        dict: Job status, version, progress and key (empty if no job)
+    """
+    job = await redis_client.hgetall(f"{EXPORT_JOB_KEY}:{map_id}:{format}")
+    job = {k.decode("utf-8"): v.decode("utf-8") for k, v in job.items()}
+    if job.get("status") == "running" and not await redis_client.exists(
+        _export_lock(map_id, format, job.get("version", ""))
+    ):
+        job["status"] = "failed"
+    return job
+
+def _export_lock(map_id: str, format: str, version: str) -> str:
+    return f"{EXPORT_JOB_KEY}_lock:{map_id}:{format}:{version}"
+
+async def _set_export_job(map_id: str, format: str, **fields) -> None:
+    job_key = f"{EXPORT_JOB_KEY}:{map_id}:{format}"
+    await redis_client.hset(job_key, mapping={k: str(v) for k, v in fields.items()})
+    await redis_client.expire(job_key, EXPORT_JOB_TTL)
+
+async def _update_export_job(map_id: str, format: str, version: str, **fields) -> bool:
+    # Jobs of older versions don't overwrite the status of a newer job
+    current = await redis_client.hget(f"{EXPORT_JOB_KEY}:{map_id}:{format}", "version")
+    if current is not None and current.decode("utf-8") != version:
+        return False
+    await _set_export_job(map_id, format, **fields)
+    return True
+
+# Keep references to running export jobs
+_export_tasks = set()
+
+async def start_export_job(
+    map_id: str,
+    version: str,
+    format: str,
+    features,
+    write_map: Callable[[zipfile.ZipFile], None],
+    s3,
+) -> bool:
+    """
+    Starts building a map export in the background, unless a job for the
+    same map version is already running.
+
+    Args:
+        map_id (str): ID of the map
+        version (str): Export version (see `export_version`)
+        format (str): Export format (geojson, csv)
+        features (List[Dict]): GeoJSON features of the map.
+        write_map (Callable): Writes the map data (GeoJSON, CSV) to the Zip.
+        s3: S3 client.
+
+    Returns:
+        bool: True if the job was started
+    """
+    lock = _export_lock(map_id, format, version)
+    if not await redis_client.set(lock, 1, nx=True, ex=EXPORT_JOB_LOCK_TTL):
+        return False
+    await _set_export_job(map_id, format, status="running", version=version, progress=0, key="")
+    task = asyncio.create_task(_run_export_job(map_id, version, format, features, write_map, s3, lock))
+    _export_tasks.add(task)
+    task.add_done_callback(_export_tasks.discard)
+    return True
+
+async def _renew_export_lock(lock: str) -> None:
+    while True:
+        await asyncio.sleep(EXPORT_JOB_LOCK_TTL / 3)
+        await redis_client.expire(lock, EXPORT_JOB_LOCK_TTL)
+
+async def _delete_old_exports(s3, map_id: str, format: str, key: str) -> None:
+    """
+    Deletes the exports of previous versions of a map, in a given format.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    async for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=f"{EXPORT_CACHE_PREFIX}/{map_id}/"):
+        objects = [
+            {'Key': obj['Key']} for obj in page.get('Contents', [])
+            if obj['Key'] != key and obj['Key'].endswith(f".{format}.zip")
+        ]
+        if objects:
+            await s3.delete_objects(Bucket=S3_BUCKET_NAME, Delete={'Objects': objects, 'Quiet': True})
+
+async def _run_export_job(map_id, version, format, features, write_map, s3, lock) -> None:
+    key = export_key(map_id, version, format)
+
+    async def on_progress(done: int, total: int):
+        if total and (done % 10 == 0 or done == total):
+            await _update_export_job(map_id, format, version, progress=round(done * 100 / total))
+
+    heartbeat = asyncio.create_task(_renew_export_lock(lock))
+    try:
+        zip_stream = stream_export(features, s3, write_map, on_progress)
+        await upload_fileobj(s3, key, AsyncIteratorReader(zip_stream), content_type="application/zip")
+        if not await _update_export_job(map_id, format, version, status="done", progress=100, key=key):
+            # The map changed while exporting, a newer job replaces this one
+            await s3.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+            return
+        logger.info(f'Export {key} done')
+    except Exception as e:
+        logger.error(f'Export {key} failed: {e}')
+        await _update_export_job(map_id, format, version, status="failed")
+        return
+    finally:
+        heartbeat.cancel()
+        await redis_client.delete(lock)
+
+    try:
+        await _delete_old_exports(s3, map_id, format, key)
+    except Exception as e:
+        logger.warning(f'Failed to delete old exports of map {map_id}: {e}')
@@ -10,38 +10,66 @@ import io
 import httpx
 import logging
 import asyncio
-import zipfile
 import json
 from pathlib import Path
-from uuid import uuid4
 from collections import defaultdict
-from aiobotocore.session import get_session
-from typing import Annotated
+from botocore.exceptions import ClientError
+from typing import Annotated, Literal, List
 from fastapi import (
     FastAPI, HTTPException, Depends, Request, APIRouter, File, UploadFile,
 )
-from fastapi.responses import StreamingResponse, FileResponse, HTMLResponse
+from fastapi.responses import (
+    StreamingResponse, FileResponse, HTMLResponse, Response, RedirectResponse,
+    JSONResponse,
+)
 from typing import Dict
 from io import BytesIO
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from db import Point, get_db_session, get_or_create_live_map, SharePermission, Map
+from db import (
+    Point, get_db_session, get_replica_db_session, get_or_create_live_map,
+    SharePermission, Map, REPLICA_DATABASE_URL, get_active_map,
+    register_media, link_media, get_media_access,
+)
 from schemas import (
     FeatureCollection, SaveMapFeatureCollection, SaveMapResult, UpdateMap,
     SaveMediaResponse, PointTags, AddPointsFeatureCollection, AddPointsResult,
+    SaveMediaBatchItem, SaveMediaBatchResponse, SessionRetention,
 )
-from sqlalchemy.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy.orm import Session
-from stream import stream_listener, clean_user_stream
+from stream import (
+    stream_listener, clean_user_stream, redis_client, set_session_retention,
+    get_sessions, queue_depths,
+)
+from deletion import purge_map, purge_deleted_maps, deletion_progress
+from derivatives import (
+    is_image, derivative_key, ensure_derivatives, schedule_derivatives,
+    shutdown_derivatives,
+)
+from media_cache import init_media_cache, get_cached_media
+from monitoring import monitor_event_loop, event_loop_metrics
+from data import shutdown_ingest, close_http_client
+from export import stream_export, export_version, get_export_job, start_export_job
+from storage import (
+    start_s3, stop_s3, get_s3_client, get_s3_presign_client, s3_metrics,
+    upload_content_addressed, MediaTooLarge,
+)
 from settings import (
     DEBUG, API_VERSION, MEDIA_FOLDER, SERVER_URL, CORS_ORIGINS,
-    S3_ACCESS_KEY, S3_SECRET_KEY, S3_BUCKET_NAME, S3_ENDPOINT_URL, API_URL,
+    S3_BUCKET_NAME, API_URL, READ_YOUR_WRITES_SEC, MEDIA_CHUNK_SIZE,
+    MEDIA_PRESIGNED_URLS, MEDIA_PRESIGNED_EXPIRES_SEC, MEDIA_MAX_UPLOAD_SIZE,
+    MAP_PURGE_INTERVAL, MEDIA_DERIVATIVES, MEDIA_MAX_AGE, MEDIA_BATCH_MAX_FILES,
+    MEDIA_BATCH_MAX_SIZE, MEDIA_BATCH_CONCURRENCY, PAIRING_WINDOW_MS,
+    STREAM_MAX_RETENTION_MIN, STREAM_LISTENER_ENABLED, STREAM_DRAIN_TIMEOUT,
+    MAP_DELETION_STATUS_TTL, MEDIA_DERIVATIVE_RETRY_SEC,
 )
 from sqlalchemy import func, select
 from geoalchemy2.shape import to_shape
-from hotosm_auth_fastapi import setup_auth, CurrentUser, CurrentUserOptional
+from hotosm_auth_fastapi import setup_auth, CurrentUser, CurrentUserOptional, AdminUser
 import csv
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 
 # Logs
 logging.basicConfig(
@@ -63,6 +91,13 @@ setup_auth(app)
 # Scheduler for background tasks (e.g., get messages and update maps)
 scheduler = AsyncIOScheduler()
 
+# Keep references to fire-and-forget tasks until they finish
+background_tasks = set()
+
+# Stream listener task, and event to stop it on shutdown
+listener_task = None
+listener_stop = asyncio.Event()
+
 # CORS Middleware Configuration
 app.add_middleware(
     CORSMiddleware,
@@ -72,13 +107,95 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class MediaUploadLimit:
+    """
+    Rejects media uploads bigger than MEDIA_MAX_UPLOAD_SIZE (or
+    MEDIA_BATCH_MAX_SIZE for batch uploads) with 413. Uploads with a bigger
+    Content-Length are rejected before reading the body, and the others
+    (e.g. chunked uploads) as soon as more bytes than allowed are received.
+
+    It's a plain ASGI middleware, so other requests and all responses
+    (e.g. streamed media) pass through untouched.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.limits = {
+            f"/{prefix}/map/media": MEDIA_MAX_UPLOAD_SIZE,
+            f"/{prefix}/map/media/batch": MEDIA_BATCH_MAX_SIZE,
+        }
+
+    async def __call__(self, scope, receive, send):
+        max_size = None
+        if scope["type"] == "http" and scope["method"] == "POST":
+            max_size = self.limits.get(scope["path"].rstrip("/"))
+        if not max_size:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max_size:
+            response = JSONResponse(status_code=413, content={"detail": "Media file too large"})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_size:
+                    # Raised while the route reads the form, and answered
+                    # by the app's exception handlers
+                    raise HTTPException(status_code=413, detail="Media file too large")
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+app.add_middleware(MediaUploadLimit)
+
 MEDIA_TYPE = defaultdict(lambda: "application/octet-stream", {
     ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
     ".png": "image/png",
+    ".webp": "image/webp",
     ".mp4": "video/mp4",
     ".opus": "audio/opus",
 })
 
+# Redis key prefix for the read-your-writes guard
+RECENT_WRITE_KEY = "recent_write"
+DELETED_MAP_KEY = "deleted_map"
+DERIVATIVE_FAILED_KEY = "derivative_failed"
+
+async def mark_recent_write(user_id: str) -> None:
+    """
+    Flag a user as having written recently, so their reads are routed
+    to the primary database until the replica catches up.
+
+    Args:
+        user_id (str): ID of the user who performed the write.
+    """
+    if REPLICA_DATABASE_URL:
+        await redis_client.set(f"{RECENT_WRITE_KEY}:{user_id}", 1, ex=READ_YOUR_WRITES_SEC)
+
+# Dependency to get a session for read-only endpoints
+async def get_read_db_session(user: CurrentUserOptional) -> Session:
+    """
+    Provides a read replica session, unless the current user has written
+    within the last READ_YOUR_WRITES_SEC seconds (read-your-writes).
+
+    Args:
+        user (CurrentUserOptional): Authenticated user (optional)
+
+    Returns:
+        Session: SQLAlchemy database session
+    """
+    if user and REPLICA_DATABASE_URL and await redis_client.exists(f"{RECENT_WRITE_KEY}:{user.id}"):
+        return get_db_session()
+    return get_replica_db_session()
+
 # QR Code Endpoint
 @api_router.get("/qr", response_class=StreamingResponse)
 async def qr(user: CurrentUser):
@@ -142,12 +259,39 @@ async def logout(user: CurrentUser) -> Dict[str, str]:
             raise HTTPException(status_code=502, detail="Failed to logout")
         return {'status': "logged out"}
 
+# Session Retention Endpoint
+@api_router.put("/retention")
+async def update_retention(
+    retention: SessionRetention,
+    user: CurrentUser,
+) -> Dict[str, int]:
+    """
+    Set how long messages from the linked device are kept before they are
+    removed. It can't be shorter than the time used for pairing locations
+    with their content.
+
+    Args:
+        retention (SessionRetention): Retention in minutes.
+        user (CurrentUser): Authenticated user.
+
+    Returns:
+        Dict[str, int]: Retention in minutes.
+    """
+    min_retention = PAIRING_WINDOW_MS // 60000
+    if not min_retention <= retention.minutes <= STREAM_MAX_RETENTION_MIN:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Retention must be between {min_retention} and {STREAM_MAX_RETENTION_MIN} minutes",
+        )
+    await set_session_retention(user.id, retention.minutes)
+    return {'minutes': retention.minutes}
+
 
 # List user maps endpoint
 @api_router.get("/user/{user_id}/map")
 async def list_user_maps(
     user_id: str,
-    db: Session = Depends(get_db_session),
+    db: Session = Depends(get_read_db_session),
 ):
     return list_maps_result(user_id, db)
 
@@ -155,7 +299,7 @@ async def list_user_maps(
 @api_router.get("/map")
 async def list_maps(
     user: CurrentUserOptional,
-    db: Session = Depends(get_db_session),
+    db: Session = Depends(get_read_db_session),
 ):
     return list_maps_result(user.id if user else None, db)
 
@@ -183,6 +327,7 @@ def list_maps_result(
         map_filter = Map.owner_id == userId
     else:
         map_filter = Map.sharing == SharePermission.PUBLIC
+    map_filter = map_filter & Map.deleted_at.is_(None)
     maps = db.execute(
         select(Map, subq.c.count)
             .join_from(Map, subq)
@@ -215,30 +360,100 @@ def list_maps_result(
 async def save_media(
     user: CurrentUser,
     file: Annotated[UploadFile, File()],
+    db: Session = Depends(get_db_session),
+    s3 = Depends(get_s3_client),
 ) -> SaveMediaResponse:
-    session = get_session()
+    if MEDIA_MAX_UPLOAD_SIZE and file.size and file.size > MEDIA_MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail="Media file too large",
+        )
 
-    s3_client_kwargs = {
-        'endpoint_url': S3_ENDPOINT_URL,
-    }
-    if S3_ACCESS_KEY:
-        s3_client_kwargs['aws_access_key_id'] = S3_ACCESS_KEY
-    if S3_SECRET_KEY:
-        s3_client_kwargs['aws_secret_access_key'] = S3_SECRET_KEY
-
-    async with session.create_client(
-        's3', **s3_client_kwargs) as client:
-        ext = Path(file.filename).suffix
-        filename = str(uuid4()) + ext
-        resp = await client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=filename,
-            Body=await file.read(),
+    # Media is stored by content hash, so duplicated files are stored once
+    ext = Path(file.filename).suffix.lower()
+    try:
+        filename, stored = await upload_content_addressed(
+            s3, file, ext,
+            content_type=MEDIA_TYPE[ext],
+            max_size=MEDIA_MAX_UPLOAD_SIZE,
+        )
+    except MediaTooLarge:
+        raise HTTPException(
+            status_code=413,
+            detail="Media file too large",
         )
+    # Duplicated files are registered too, so the uploader can access them
+    register_media(db, filename, user.id)
+    db.commit()
+    await mark_recent_write(user.id)
+    if stored:
+        schedule_derivatives(s3, filename)
+    else:
+        logger.debug(f'Media already stored: {filename}')
 
     return SaveMediaResponse(uri=f"{API_URL}/v1/media/{filename}")
 
 
+@api_router.post("/map/media/batch")
+async def save_media_batch(
+    user: CurrentUser,
+    files: Annotated[List[UploadFile], File()],
+    db: Session = Depends(get_db_session),
+    s3 = Depends(get_s3_client),
+) -> SaveMediaBatchResponse:
+    """
+    Uploads many media files in a single request. Files are written to S3
+    concurrently (up to MEDIA_BATCH_CONCURRENCY at a time) and results are
+    returned in the same order as the files, with an error for each file
+    that couldn't be saved.
+    """
+    if len(files) > MEDIA_BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many files (max {MEDIA_BATCH_MAX_FILES})",
+        )
+
+    semaphore = asyncio.Semaphore(MEDIA_BATCH_CONCURRENCY)
+    saved = set()
+    stored = set()
+
+    async def save(file: UploadFile) -> SaveMediaBatchItem:
+        if MEDIA_MAX_UPLOAD_SIZE and file.size and file.size > MEDIA_MAX_UPLOAD_SIZE:
+            return SaveMediaBatchItem(filename=file.filename, error="Media file too large")
+        async with semaphore:
+            try:
+                ext = Path(file.filename).suffix.lower()
+                filename, new = await upload_content_addressed(
+                    s3, file, ext,
+                    content_type=MEDIA_TYPE[ext],
+                    max_size=MEDIA_MAX_UPLOAD_SIZE,
+                )
+                saved.add(filename)
+                if new:
+                    stored.add(filename)
+                else:
+                    logger.debug(f'Media already stored: {filename}')
+            except MediaTooLarge:
+                return SaveMediaBatchItem(filename=file.filename, error="Media file too large")
+            except Exception as e:
+                logger.error(f"Error uploading {file.filename}: {e}")
+                return SaveMediaBatchItem(filename=file.filename, error="Upload failed")
+        return SaveMediaBatchItem(filename=file.filename, uri=f"{API_URL}/v1/media/{filename}")
+
+    results = await asyncio.gather(*(save(file) for file in files))
+
+    # Register all files (duplicates included) in a single transaction
+    if saved:
+        for filename in saved:
+            register_media(db, filename, user.id)
+        db.commit()
+        await mark_recent_write(user.id)
+        for filename in stored:
+            schedule_derivatives(s3, filename)
+
+    return SaveMediaBatchResponse(files=results)
+
+
 @api_router.post("/map")
 async def create_map(
     map_data: SaveMapFeatureCollection,
@@ -250,7 +465,7 @@ async def create_map(
         db.add(new_map)
         db.flush()
 
-        db.add_all([Point(
+        points = [Point(
             geom=f"POINT ({feature.geometry.coordinates[0]} {feature.geometry.coordinates[1]})",
             message=feature.properties.message,
             username=feature.properties.username,
@@ -259,7 +474,15 @@ async def create_map(
             tags=feature.properties.tags,
             removed=feature.properties.removed or False,
             map_id=new_map.id,
-        ) for feature in map_data.features])
+        ) for feature in map_data.features]
+        db.add_all(points)
+        db.flush()
+
+        # Register media used by the map
+        link_media(db, new_map.id, user.id, [
+            {"id": point.id, "file": point.file} for point in points
+        ])
+    await mark_recent_write(user.id)
 
     return SaveMapResult(id=new_map.id, name=new_map.name)
 
@@ -283,7 +506,7 @@ async def add_points_to_map(
     Returns:
         Dict[str, str]: Updated map ID
     """
-    map = db.get(Map, map_id)
+    map = get_active_map(db, map_id)
 
     if map is None or map.owner_id != user.id:
         raise HTTPException(
@@ -291,7 +514,7 @@ async def add_points_to_map(
             detail="Map not found",
         )
 
-    db.add_all([Point(
+    points = [Point(
         geom=f"POINT ({feature.geometry.coordinates[0]} {feature.geometry.coordinates[1]})",
         message=feature.properties.message,
         username=feature.properties.username,
@@ -300,19 +523,39 @@ async def add_points_to_map(
         tags=feature.properties.tags,
         removed=feature.properties.removed or False,
         map_id=map.id,
-    ) for feature in map_data.features])
+    ) for feature in map_data.features]
+    db.add_all(points)
+    db.flush()
+
+    # Register media used by the new points
+    link_media(db, map.id, user.id, [
+        {"id": point.id, "file": point.file} for point in points
+    ])
     db.commit()
+    await mark_recent_write(user.id)
 
     return AddPointsResult(id=map_id, count=len(map_data.features))
 
 
-@api_router.delete("/map/{map_id}")
+@api_router.delete("/map/{map_id}", status_code=202)
 async def delete_map(
     map_id: str,
     user: CurrentUser,
     db: Session = Depends(get_db_session),
-):
-    map = db.get(Map, map_id)
+    s3 = Depends(get_s3_client),
+) -> Dict[str, str]:
+    """
+    Mark a map as deleted and purge its points and media in the background.
+
+    Args:
+        map_id (str): Unique identifier of the map.
+        user (CurrentUser): Authenticated user.
+        db (Session): Database session.
+
+    Returns:
+        Dict[str, str]: Map ID and deletion status.
+    """
+    map = get_active_map(db, map_id)
 
     if map is None or map.owner_id != user.id:
         raise HTTPException(
@@ -320,34 +563,53 @@ async def delete_map(
             detail="Map not found",
         )
 
-    # Delete media associated with the map
-    session = get_session()
+    map.deleted_at = datetime.now()
+    map.is_live = False
+    db.commit()
+    await mark_recent_write(user.id)
+    # Remember the owner, to report the deletion once the map is purged
+    await redis_client.set(f"{DELETED_MAP_KEY}:{map_id}", user.id, ex=MAP_DELETION_STATUS_TTL)
+
+    task = asyncio.create_task(purge_map(map_id, s3))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
-    s3_client_kwargs = {
-        'endpoint_url': S3_ENDPOINT_URL,
-    }
-    if S3_ACCESS_KEY:
-        s3_client_kwargs['aws_access_key_id'] = S3_ACCESS_KEY
-    if S3_SECRET_KEY:
-        s3_client_kwargs['aws_secret_access_key'] = S3_SECRET_KEY
-
-    async with session.create_client(
-        's3', **s3_client_kwargs) as client:
-        for point in map.points:
-            if not point.file:
-                continue
-
-            filename = point.file.rsplit("/", 1)
-
-            resp = await client.delete_object(
-                Bucket=S3_BUCKET_NAME,
-                Key=filename[-1],
-            )
+    return {"map_id": map_id, "status": "deleting"}
 
-    db.delete(map)
-    db.commit()
 
-    return
+@api_router.get("/map/{map_id}/deletion")
+async def get_map_deletion(
+    map_id: str,
+    user: CurrentUser,
+    db: Session = Depends(get_db_session),
+):
+    """
+    Get the progress of a map deletion.
+
+    Args:
+        map_id (str): Unique identifier of the map.
+        user (CurrentUser): Authenticated user.
+        db (Session): Database session.
+
+    Returns:
+        Dict: Deletion status and remaining points and media files.
+    """
+    map = db.get(Map, map_id)
+    if map is None:
+        # Purged maps are reported as deleted to their owner only
+        owner_id = await redis_client.get(f"{DELETED_MAP_KEY}:{map_id}")
+        if owner_id is not None and owner_id.decode() == user.id:
+            return {"map_id": map_id, "status": "deleted", "points": 0, "media": 0}
+        raise HTTPException(
+            status_code=404,
+            detail="Map not found",
+        )
+    if map.owner_id != user.id or map.deleted_at is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Map not found",
+        )
+    return {"map_id": map_id, "status": "deleting", **deletion_progress(db, map_id)}
 
 @api_router.get("/media_player/{media_url}", response_class=HTMLResponse)
 async def get_video_player(
@@ -364,6 +626,13 @@ async def get_video_player(
     Returns:
         HTML for a video player
     """
+    # Files saved by the legacy ingestion are served from the media folder,
+    # everything else is streamed from S3 (with Range support for seeking)
+    if os.path.isfile(os.path.join(MEDIA_FOLDER, media_url)):
+        source_url = f"{API_URL}/v{API_VERSION}/media?filename={media_url}"
+    else:
+        source_url = f"{API_URL}/v{API_VERSION}/media/{media_url}"
+
     html_response = f"""
     <!DOCTYPE html>
     <html>
@@ -374,7 +643,7 @@ async def get_video_player(
     if media_url.endswith("mp4"):
         html_response += f"""
         <video width="490" height="350" style="background-color: #111; border-radius: 4px" controls>
-        <source src="{API_URL}/v{API_VERSION}/media?filename={media_url}" type="video/mp4">
+        <source src="{source_url}" type="video/mp4">
         Your browser does not support the video tag.
         </video>
         """
@@ -387,7 +656,7 @@ async def get_video_player(
         file_type = media_url[-4:] if media_url.endswith("opus") else media_url[-3:]
         html_response += f"""
         <audio width="490" height="68" style="background-color: #111; border-radius: 4px" controls>
-        <source src="{API_URL}/v{API_VERSION}/media?filename={media_url}" type="audio/{file_type}">
+        <source src="{source_url}" type="audio/{file_type}">
         Your browser does not support the audio tag.
         </audio>
         """
@@ -404,7 +673,10 @@ def html_for_embedded_media(file):
       filename = file.split("=")[1] if "=" in file else file.split("media/")[1]
       file_url = f"{API_URL}/v{API_VERSION}/media_player/{filename}"
       if file.endswith("jpg") or file.endswith("jpeg"):
-        return f"<img src=\"{file}\" />"
+        # Legacy files (media?filename=) are served as they are
+        if "=" in file or not MEDIA_DERIVATIVES:
+          return f"<img src=\"{file}\" />"
+        return f"<img src=\"{API_URL}/v{API_VERSION}/media/{filename}?size=medium\" />"
       elif file.endswith("mp4"):
         return f"<iframe width=\"495\" height=\"365\" src=\"{file_url}\" title=\"Video player\" scrolling=\"no\" frameborder=\"0\"></iframe>"
       elif (file.endswith("ogg") or
@@ -490,7 +762,7 @@ async def get_map(
         FeatureCollection: GeoJSON FeatureCollection of points.
     """
     map_id = get_or_create_live_map(db, user.id)
-    map_obj: Map = db.get(Map, map_id)
+    map_obj: Map = get_active_map(db, map_id)
 
     return map_response(db, map_obj, True)
 
@@ -500,7 +772,7 @@ async def get_public_map(
     map_id: str,
     request: Request,
     user: CurrentUserOptional,
-    db: Session = Depends(get_db_session),
+    db: Session = Depends(get_read_db_session),
 ):
     """
     Retrieve public map data (GeoJSON) for a given map ID.
@@ -513,9 +785,9 @@ async def get_public_map(
     Returns:
         FeatureCollection: GeoJSON FeatureCollection of points.
     """
-    map_obj: Map = db.get(Map, map_id)
+    map_obj: Map = get_active_map(db, map_id)
 
-    owner = (user and map_obj.owner_id == user.id) or False
+    owner = (user and map_obj and map_obj.owner_id == user.id) or False
     if map_obj and (map_obj.sharing == SharePermission.PUBLIC or owner):
         return map_response(db, map_obj, owner)
     else:
@@ -544,7 +816,7 @@ async def status(
     Returns:
         Dict[str, str]: Updated map ID and sharing status.
     """
-    map_obj: Map = db.get(Map, map_id)
+    map_obj: Map = get_active_map(db, map_id)
     if map_obj and user and map_obj.owner_id == user.id:
         sharing = (
             SharePermission.PUBLIC
@@ -553,6 +825,7 @@ async def status(
         )
         map_obj.sharing = sharing
         db.commit()
+        await mark_recent_write(user.id)
         return {"map_id": map_id, "sharing": map_obj.sharing.value}
     else:
         # User is not owner of the map
@@ -579,10 +852,11 @@ async def status(
     Returns:
         Dict[str, str]: Updated map ID and is_live status.
     """
-    map_obj: Map = db.get(Map, map_id)
+    map_obj: Map = get_active_map(db, map_id)
     if map_obj and user and map_obj.owner_id == user.id:
         map_obj.is_live = False
         db.commit()
+        await mark_recent_write(user.id)
         await clean_user_stream(user.id)
         return {"is_live": map_obj.is_live}
     else:
@@ -612,11 +886,12 @@ async def status(
     Returns:
         Dict[str, str]: Updated map ID, title and descrition.
     """
-    map_obj: Map = db.get(Map, map_id)
+    map_obj: Map = get_active_map(db, map_id)
     if map_obj and user and map_obj.owner_id == user.id:
         map_obj.name = map_data.name
         map_obj.description = map_data.description
         db.commit()
+        await mark_recent_write(user.id)
         return {"map_id": map_id, "name": map_obj.name, "description": map_obj.description}
     else:
         # User is not owner of the map
@@ -635,9 +910,10 @@ async def remove_point(
     point_obj: Point = db.get(Point, point_id)
     if point_obj:
         map_obj = point_obj.map
-        if map_obj.owner_id == user.id:
+        if map_obj.owner_id == user.id and map_obj.deleted_at is None:
             point_obj.removed = not point_obj.removed
             db.commit()
+            await mark_recent_write(user.id)
             return {"removed": point_obj.removed}
         else:
             # User is not owner of the map
@@ -660,9 +936,10 @@ async def update_point_tags(
     point_obj: Point = db.get(Point, point_id)
     if point_obj:
         map_obj = point_obj.map
-        if map_obj.owner_id == user.id:
+        if map_obj.owner_id == user.id and map_obj.deleted_at is None:
             point_obj.tags = tags.tags
             db.commit()
+            await mark_recent_write(user.id)
             return {"tags": point_obj.tags}
         else:
             # User is not owner of the map
@@ -675,70 +952,261 @@ async def update_point_tags(
         detail="Point not found",
     )
 
-@api_router.get("/media/{filename}", response_class=StreamingResponse)
+async def presigned_media_redirect(filename: str, access: SharePermission, s3) -> RedirectResponse:
+    """
+    Redirect to a short-lived presigned S3 URL for a media file, so the
+    object store serves the bytes instead of the API.
+
+    Args:
+        filename (str): Object key of the media file.
+        access (SharePermission): Access level for the media file.
+        s3: S3 client configured with the public endpoint.
+
+    Returns:
+        RedirectResponse: Temporary redirect to the presigned URL
+    """
+    url = await s3.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': S3_BUCKET_NAME,
+            'Key': filename,
+            'ResponseContentType': MEDIA_TYPE[Path(filename).suffix],
+        },
+        ExpiresIn=MEDIA_PRESIGNED_EXPIRES_SEC,
+    )
+
+    # Cached redirects must expire well before the presigned URL does
+    if access == SharePermission.PUBLIC:
+        cache_control = f"public, max-age={MEDIA_PRESIGNED_EXPIRES_SEC // 2}"
+    else:
+        cache_control = "private, no-store"
+    return RedirectResponse(url, status_code=307, headers={"Cache-Control": cache_control})
+
+# HTTP caching headers for media files
+def media_cache_headers(key: str, access: SharePermission) -> Dict[str, str]:
+    """
+    Media keys are never overwritten, so media files can be cached for
+    MEDIA_MAX_AGE by browsers (and by proxies, if the media is public).
+
+    Args:
+        key (str): Object key of the media file.
+        access (SharePermission): Access level for the media file.
+
+    Returns:
+        Dict[str, str]: Cache-Control and ETag headers
+    """
+    visibility = "public" if access == SharePermission.PUBLIC else "private"
+    return {
+        "Cache-Control": f"{visibility}, max-age={MEDIA_MAX_AGE}, immutable",
+        "ETag": f'"{key}"',
+    }
+
+def parse_http_date(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+def file_not_modified(request: Request, path: str) -> bool:
+    """
+    Checks the If-Modified-Since header of a request against a local file.
+    Ignored if the request has an If-None-Match header.
+
+    Args:
+        request (Request): FastAPI request object.
+        path (str): Path of the file.
+
+    Returns:
+        bool: True if the file didn't change since the given date
+    """
+    if_modified_since = parse_http_date(request.headers.get("if-modified-since"))
+    if not if_modified_since or request.headers.get("if-none-match"):
+        return False
+    last_modified = datetime.fromtimestamp(int(os.stat(path).st_mtime), timezone.utc)
+    return last_modified <= if_modified_since
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Checks the If-None-Match header of a request against an ETag.
+
+    Args:
+        request (Request): FastAPI request object.
+        etag (str): ETag of the resource.
+
+    Returns:
+        bool: True if the client already has this version of the resource
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+async def s3_object_response(
+    request: Request,
+    s3,
+    key: str,
+    media_type: str,
+    headers: Dict[str, str] | None = None,
+) -> Response:
+    """
+    Stream an object from S3 in chunks, forwarding HTTP Range requests
+    (206 Partial Content) and answering HEAD requests from its metadata.
+
+    Args:
+        request (Request): FastAPI request object.
+        s3: S3 client.
+        key (str): Object key.
+        media_type (str): Content type of the response.
+        headers (Dict[str, str]): Extra response headers (optional)
+
+    Returns:
+        StreamingResponse: Streamed object (or part of it)
+    """
+    # Conditional requests are answered by S3 from the object metadata
+    conditional_kwargs = {}
+    if_modified_since = parse_http_date(request.headers.get("if-modified-since"))
+    if if_modified_since and not request.headers.get("if-none-match"):
+        conditional_kwargs["IfModifiedSince"] = if_modified_since
+    try:
+        if request.method == "HEAD":
+            resp = await s3.head_object(Bucket=S3_BUCKET_NAME, Key=key, **conditional_kwargs)
+        else:
+            range_kwargs = {}
+            range_header = request.headers.get("range")
+            if range_header and range_header.startswith("bytes="):
+                range_kwargs["Range"] = range_header
+            resp = await s3.get_object(Bucket=S3_BUCKET_NAME, Key=key, **range_kwargs, **conditional_kwargs)
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code == "304":
+            return Response(status_code=304, headers=headers)
+        if code == "InvalidRange":
+            raise HTTPException(
+                status_code=416,
+                detail="Requested range not satisfiable",
+            )
+        if code in ("NoSuchKey", "404"):
+            raise HTTPException(
+                status_code=404,
+                detail="Media not found",
+            )
+        raise
+
+    headers = {
+        **(headers or {}),
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(resp["ContentLength"]),
+    }
+    if resp.get("LastModified"):
+        headers["Last-Modified"] = format_datetime(resp["LastModified"], usegmt=True)
+    status_code = 200
+    if resp.get("ContentRange"):
+        headers["Content-Range"] = resp["ContentRange"]
+        status_code = 206
+
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+
+    async def stream_body():
+        async with resp['Body'] as body:
+            async for chunk in body.iter_chunks(MEDIA_CHUNK_SIZE):
+                yield chunk
+
+    return StreamingResponse(
+        stream_body(),
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type,
+    )
+
+
+@api_router.api_route("/media/{filename}", methods=["GET", "HEAD"], response_class=StreamingResponse)
 async def get_media(
     filename: str,
+    request: Request,
     user: CurrentUserOptional,
-    db: Session = Depends(get_db_session),
+    size: Literal["thumb", "medium"] | None = None,
+    db: Session = Depends(get_read_db_session),
+    s3 = Depends(get_s3_client),
+    s3_presign = Depends(get_s3_presign_client),
 ):
+    """
+    Stream a media file from S3, supporting HTTP Range requests
+    (206 Partial Content) and HEAD.
+
+    Args:
+        filename (str): Object key of the media file.
+        request (Request): FastAPI request object.
+        user (CurrentUserOptional): Authenticated user (optional)
+        size (str): Derivative size for images (thumb, medium), optional.
+        db (Session): Database session.
+
+    Returns:
+        StreamingResponse: Streamed media file (or part of it)
+    """
     # first check if file is registered and accesible to the current user
-    try:
-        point = db.query(Point).filter(Point.file.like(f"%{filename}")).one()
-    except NoResultFound:
+    access = get_media_access(db, filename, user.id if user else None)
+    if access is None:
         raise HTTPException(
             status_code=404,
             detail="Media not found",
         )
-    except MultipleResultsFound:
-        points = db.query(Point).filter(Point.file.like(f"%{filename}%")).all()
-        point = points[0] if points else None
-        if point:
-            map_obj = point.map
-
-            if map_obj.sharing != SharePermission.PUBLIC and (not user or map_obj.owner_id != user.id):
-                raise HTTPException(
-                    status_code=404,
-                    detail="Media not found",
-                )
-        else:
-            raise HTTPException(
-                status_code=404,
-                detail="Media not found",
-            )
 
-    session = get_session()
+    key = filename
+    if size and MEDIA_DERIVATIVES and is_image(filename):
+        key = derivative_key(filename, size)
 
-    s3_client_kwargs = {
-        'endpoint_url': S3_ENDPOINT_URL,
-    }
-    if S3_ACCESS_KEY:
-        s3_client_kwargs['aws_access_key_id'] = S3_ACCESS_KEY
-    if S3_SECRET_KEY:
-        s3_client_kwargs['aws_secret_access_key'] = S3_SECRET_KEY
+    # Media never changes, answer conditional requests without reading it
+    headers = media_cache_headers(key, access)
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
 
-    async with session.create_client(
-        's3', **s3_client_kwargs) as client:
+    if key != filename:
         try:
-            resp = await client.get_object(Bucket=S3_BUCKET_NAME, Key=filename)
-
-            ext = Path(filename).suffix
-
-            async with resp['Body'] as stream:
-                return StreamingResponse(BytesIO(await stream.read()), media_type=MEDIA_TYPE[ext])
-        except client.exceptions.NoSuchKey:
-            raise HTTPException(
-                status_code=404,
-                detail="Media not found",
-            )
+            await s3.head_object(Bucket=S3_BUCKET_NAME, Key=key)
+        except ClientError:
+            # Derivative is missing, generate it now (unless it failed recently)
+            derivatives = {}
+            failed_key = f"{DERIVATIVE_FAILED_KEY}:{filename}"
+            if not await redis_client.exists(failed_key):
+                derivatives = await ensure_derivatives(s3, filename)
+                if not derivatives:
+                    await redis_client.set(failed_key, 1, ex=MEDIA_DERIVATIVE_RETRY_SEC)
+            if size in derivatives:
+                if not MEDIA_PRESIGNED_URLS:
+                    return Response(derivatives[size], headers=headers, media_type=MEDIA_TYPE[Path(key).suffix])
+            else:
+                # Serve the original image instead
+                key = filename
+                headers = media_cache_headers(key, access)
+                if etag_matches(request, headers["ETag"]):
+                    return Response(status_code=304, headers=headers)
+
+    if MEDIA_PRESIGNED_URLS and request.method == "GET":
+        return await presigned_media_redirect(key, access, s3_presign)
+
+    # Serve hot media from the local disk cache
+    cached_path = await get_cached_media(s3, key)
+    if cached_path:
+        if file_not_modified(request, cached_path):
+            return Response(status_code=304, headers=headers)
+        return FileResponse(path=cached_path, headers=headers, media_type=MEDIA_TYPE[Path(key).suffix])
+
+    return await s3_object_response(request, s3, key, MEDIA_TYPE[Path(key).suffix], headers)
 
 # Media File Endpoint
 @api_router.get("/media")
-async def media(filename: str) -> Dict[str, str]:
+async def media(filename: str, request: Request) -> Dict[str, str]:
     """
     Serve media files (images, videos, audio)
 
     Args:
         filename (str): Name of the media file.
+        request (Request): FastAPI request object.
 
     Returns:
         FileResponse or error message.
@@ -746,14 +1214,64 @@ async def media(filename: str) -> Dict[str, str]:
     file_path = os.path.join(MEDIA_FOLDER, filename)
     if not os.path.isfile(file_path):
         return {"error": "File not found"}
+    headers = media_cache_headers(filename, SharePermission.PUBLIC)
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if file_not_modified(request, file_path):
+        return Response(status_code=304, headers=headers)
     if filename[-3:] == "jpg":
-        return FileResponse(path=file_path, media_type="image/jpeg")
+        return FileResponse(path=file_path, headers=headers, media_type="image/jpeg")
     elif filename[-3:] == "mp4":
-        return FileResponse(path=file_path, media_type="video/mp4")
+        return FileResponse(path=file_path, headers=headers, media_type="video/mp4")
     elif filename[-4:] == "opus":
-        return FileResponse(path=file_path, media_type="audio/opus")
+        return FileResponse(path=file_path, headers=headers, media_type="audio/opus")
     return {"error": "Format unknown"}
 
+# S3 client pool metrics
+@api_router.get("/metrics/s3")
+async def get_s3_metrics(admin: AdminUser) -> Dict[str, int]:
+    """
+    Return basic metrics for the shared S3 client pool (admins only).
+
+    Args:
+        admin (AdminUser): Authenticated admin user.
+
+    Returns:
+        Dict[str, int]: Pool size, total, in-flight and failed requests.
+    """
+    return s3_metrics()
+
+# Event loop metrics
+@api_router.get("/metrics/event_loop")
+async def get_event_loop_metrics(admin: AdminUser) -> Dict[str, int]:
+    """
+    Return how long the event loop has been blocked, e.g. by ingestion
+    (admins only).
+
+    Args:
+        admin (AdminUser): Authenticated admin user.
+
+    Returns:
+        Dict[str, int]: Number of stalls, total stall time, max and last delay (in ms).
+    """
+    return event_loop_metrics()
+
+# Stream queue metrics
+@api_router.get("/metrics/stream")
+async def get_stream_metrics(admin: AdminUser) -> Dict[str, Dict[str, int]]:
+    """
+    Return the queue depth of each active session: messages not read
+    yet by the ingestion workers (lag) and messages being processed
+    (pending). Admins only, as sessions are identified by user.
+
+    Args:
+        admin (AdminUser): Authenticated admin user.
+
+    Returns:
+        Dict[str, Dict[str, int]]: Lag and pending messages for each session.
+    """
+    return await queue_depths(list(await get_sessions()))
+
 # Protected User Info Endpoint
 @api_router.get("/me")
 async def me(user: CurrentUser):
@@ -773,75 +1291,6 @@ async def me(user: CurrentUser):
     }
 
 
-# Export media
-async def export_media(features, zf):
-    async with httpx.AsyncClient() as client:
-        for feature in features:
-            fileUrl = feature['properties']['file']
-            if not fileUrl:
-                continue
-            try:
-                response = await client.get(fileUrl)
-                response.raise_for_status()  # Raise for 4xx/5xx
-                content = response.content
-                # Get filename
-                filename = fileUrl.replace("media?filename=", "/")
-                filename = filename[filename.rfind("/") + 1:]
-                # Update file properties
-                feature['properties']['file_url'] = feature['properties']['file']
-                feature['properties']['file'] = filename
-                # Add file to zip
-                zf.writestr(filename, content)
-            except httpx.HTTPError as e:
-                logger.error(f"Failed to download: {str(e)}")
-
-
-# Export map as Zip (GeoJSON + media)
-@api_router.get("/export/{map_id}", response_model=None)
-async def export(
-    map_id: str,
-    request: Request,
-    user: CurrentUserOptional,
-    db: Session = Depends(get_db_session),
-):
-    """
-    Export map for download (Zip w/ GeoJSON and media) for a given map ID.
-
-    Args:
-        map_id (str): Unique identifier of the map.
-        request (Request): FastAPI request object.
-        db (Session): Database session.
-
-    Returns:
-        StreamingResponse
-    """
-
-    # Get map
-    map_obj: Map = db.get(Map, map_id)
-    owner = (user and map_obj.owner_id == user.id) or False
-    if map_obj and owner:
-        map = map_response(db, map_obj, owner)
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            # Get map files
-            await export_media(map['features'], zf)
-            # Replace 'id' by '_chatmapId'
-            map['_chatmapId'] = map['id']
-            del map['id']
-            zf.writestr(f"chatmap_{map_id}.geojson", json.dumps(map, default=str))
-        memory_file.seek(0)
-        return StreamingResponse(
-            memory_file,
-            media_type="application/zip",
-            headers={"Content-Disposition": f"attachment; filename=chatmap_{map_id}.zip"}
-        )
-    else:
-        # Map is not public – reject the request
-        raise HTTPException(
-            status_code=401,
-            detail="Unauthorized: the requested map is not publicly shared."
-        )
-
 def map_to_csv(features):
     """
     Convert a map dictionary to a CSV.
@@ -887,44 +1336,67 @@ def map_to_csv(features):
 
     return csv_string
 
-# Export map as Zip (CSV + media)
-@api_router.get("/export/csv/{map_id}", response_model=None)
-async def export(
-    map_id: str,
-    request: Request,
-    user: CurrentUserOptional,
-    db: Session = Depends(get_db_session),
-):
+# Function for writing the map data (GeoJSON or CSV) into an export
+def map_export_writer(map, map_id: str, format: str):
     """
-    Export map for download (Zip w/ CSV and media) for a given map ID.
+    Returns a function writing the map data into the export Zip file,
+    once its media files (and their names in the features) are ready.
 
     Args:
+        map (Dict): Map data, as returned by map_response()
         map_id (str): Unique identifier of the map.
+        format (str): Export format (geojson, csv)
+
+    Returns:
+        Callable[[ZipFile], None]
+    """
+    def write_geojson(zf):
+        # Replace 'id' by '_chatmapId'
+        map['_chatmapId'] = map['id']
+        del map['id']
+        zf.writestr(f"chatmap_{map_id}.geojson", json.dumps(map, default=str))
+
+    def write_csv(zf):
+        zf.writestr(f"chatmap_{map_id}.csv", map_to_csv(map['features']))
+
+    return write_csv if format == "csv" else write_geojson
+
+# Function for exporting a map (cached artifact or streamed Zip)
+async def export_response(map_id, format, request, user, db, s3):
+    """
+    Serve a map export for download, from the cached artifact built by an
+    export job if it matches the current map version (with Range support),
+    or streaming a new Zip file otherwise.
+
+    Args:
+        map_id (str): Unique identifier of the map.
+        format (str): Export format (geojson, csv)
         request (Request): FastAPI request object.
+        user (CurrentUserOptional): Authenticated user (optional)
         db (Session): Database session.
+        s3: S3 client.
 
     Returns:
         StreamingResponse
     """
 
     # Get map
-    map_obj: Map = db.get(Map, map_id)
-    owner = (user and map_obj.owner_id == user.id) or False
+    map_obj: Map = get_active_map(db, map_id)
+    owner = (user and map_obj and map_obj.owner_id == user.id) or False
     if map_obj and owner:
+        headers = {"Content-Disposition": f"attachment; filename=chatmap_{map_id}.zip"}
+
+        # Serve cached export
+        version = export_version(map_obj)
+        job = await get_export_job(map_id, format)
+        if job.get("status") == "done" and job.get("version") == version:
+            return await s3_object_response(request, s3, job["key"], "application/zip", headers)
+
         map = map_response(db, map_obj, owner)
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            # Get map files
-            await export_media(map['features'], zf)
-            # Replace 'id' by '_chatmapId'
-            map['_chatmapId'] = map['id']
-            del map['id']
-            zf.writestr(f"chatmap_{map_id}.csv", map_to_csv(map['features']))
-        memory_file.seek(0)
         return StreamingResponse(
-            memory_file,
+            stream_export(map['features'], s3, map_export_writer(map, map_id, format)),
             media_type="application/zip",
-            headers={"Content-Disposition": f"attachment; filename=chatmap_{map_id}.zip"}
+            headers=headers,
         )
     else:
         # Map is not public – reject the request
@@ -933,6 +1405,132 @@ async def export(
             detail="Unauthorized: the requested map is not publicly shared."
         )
 
+# Export map as Zip (GeoJSON + media)
+@api_router.get("/export/{map_id}", response_model=None)
+async def export(
+    map_id: str,
+    request: Request,
+    user: CurrentUserOptional,
+    db: Session = Depends(get_read_db_session),
+    s3 = Depends(get_s3_client),
+):
+    """
+    Export map for download (Zip w/ GeoJSON and media) for a given map ID.
+
+    Args:
+        map_id (str): Unique identifier of the map.
+        request (Request): FastAPI request object.
+        db (Session): Database session.
+
+    Returns:
+        StreamingResponse
+    """
+    return await export_response(map_id, "geojson", request, user, db, s3)
+
+# Export map as Zip (CSV + media)
+@api_router.get("/export/csv/{map_id}", response_model=None)
+async def export(
+    map_id: str,
+    request: Request,
+    user: CurrentUserOptional,
+    db: Session = Depends(get_read_db_session),
+    s3 = Depends(get_s3_client),
+):
+    """
+    Export map for download (Zip w/ CSV and media) for a given map ID.
+
+    Args:
+        map_id (str): Unique identifier of the map.
+        request (Request): FastAPI request object.
+        db (Session): Database session.
+
+    Returns:
+        StreamingResponse
+    """
+    return await export_response(map_id, "csv", request, user, db, s3)
+
+# Export job status response
+def export_job_response(map_id: str, format: str, job: Dict[str, str]) -> Dict[str, str]:
+    download_path = f"export/csv/{map_id}" if format == "csv" else f"export/{map_id}"
+    return {
+        "map_id": map_id,
+        "format": format,
+        "status": job.get("status", "none"),
+        "progress": int(job.get("progress", 0)),
+        "url": f"{API_URL}/{prefix}/{download_path}" if job.get("status") == "done" else None,
+    }
+
+# Start an export job
+@api_router.post("/export/{map_id}", status_code=202)
+async def create_export_job(
+    map_id: str,
+    user: CurrentUser,
+    format: Literal["geojson", "csv"] = "geojson",
+    db: Session = Depends(get_db_session),
+    s3 = Depends(get_s3_client),
+):
+    """
+    Build a map export (Zip w/ GeoJSON or CSV and media) in the background.
+    The export is stored and reused until the map changes.
+
+    Args:
+        map_id (str): Unique identifier of the map.
+        user (CurrentUser): Authenticated user.
+        format (str): Export format (geojson, csv)
+        db (Session): Database session.
+
+    Returns:
+        Dict: Export job status
+    """
+    map_obj: Map = get_active_map(db, map_id)
+    if map_obj is None or map_obj.owner_id != user.id:
+        raise HTTPException(
+            status_code=401,
+            detail="Unauthorized."
+        )
+
+    version = export_version(map_obj)
+    job = await get_export_job(map_id, format)
+    if job.get("version") != version or job.get("status") == "failed":
+        map = map_response(db, map_obj, True)
+        await start_export_job(
+            map_id, version, format, map['features'],
+            map_export_writer(map, map_id, format), s3,
+        )
+        job = await get_export_job(map_id, format)
+    return export_job_response(map_id, format, job)
+
+# Get export job status
+@api_router.get("/export/{map_id}/status")
+async def get_export_job_status(
+    map_id: str,
+    user: CurrentUser,
+    format: Literal["geojson", "csv"] = "geojson",
+    db: Session = Depends(get_read_db_session),
+):
+    """
+    Get the status and progress of the last export job for a map.
+
+    Args:
+        map_id (str): Unique identifier of the map.
+        user (CurrentUser): Authenticated user.
+        format (str): Export format (geojson, csv)
+        db (Session): Database session.
+
+    Returns:
+        Dict: Export job status
+    """
+    map_obj: Map = get_active_map(db, map_id)
+    if map_obj is None or map_obj.owner_id != user.id:
+        raise HTTPException(
+            status_code=401,
+            detail="Unauthorized."
+        )
+    job = await get_export_job(map_id, format)
+    if job.get("version") != export_version(map_obj):
+        job = {}
+    return export_job_response(map_id, format, job)
+
 # Include API Router
 app.include_router(api_router)
 
@@ -941,13 +1539,27 @@ app.include_router(api_router)
 async def startup_event():
     """
     Perform actions when the API starts up.
-    Ensures media directory exists and starts the Redis stream listener.
+    Ensures media directory exists and starts the Redis stream listener,
+    unless ingestion runs in a separate worker (see worker.py).
     """
     print(f"Starting ...")
-    global scheduler
+    global scheduler, listener_task
     if not os.path.exists("media"):
         os.mkdir("media")
-    asyncio.create_task(stream_listener())
+    await start_s3()
+    await asyncio.to_thread(init_media_cache)
+    # Retry interrupted map deletions
+    scheduler.add_job(
+        purge_deleted_maps, 'interval',
+        seconds=MAP_PURGE_INTERVAL, args=[get_s3_client()],
+        max_instances=1, coalesce=True,
+    )
+    scheduler.start()
+    task = asyncio.create_task(monitor_event_loop())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    if STREAM_LISTENER_ENABLED:
+        listener_task = asyncio.create_task(stream_listener(listener_stop))
 
 # On API shutdown
 @api_router.on_event("shutdown")
@@ -956,3 +1568,15 @@ async def shutdown_event():
     Perform actions when the API shuts down.
     """
     print(f"Shutting down ...")
+    scheduler.shutdown(wait=False)
+    # Let the stream listener finish the sessions in progress
+    if listener_task is not None:
+        listener_stop.set()
+        try:
+            await asyncio.wait_for(listener_task, STREAM_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Stream listener didn't stop in time")
+    shutdown_derivatives()
+    shutdown_ingest()
+    await close_http_client()
+    await stop_s3()
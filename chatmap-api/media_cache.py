@@ -0,0 +1,207 @@
+"""
+This module implements an optional local disk cache in front of S3 for
+hot media files, bounded to MEDIA_CACHE_MAX_BYTES with LRU eviction.
+
+Files are written atomically (temporary file + rename), and concurrent
+requests for the same missing file wait for a single fill instead of
+downloading it several times. Cached files are served with FileResponse,
+which uses zero-copy sends when the server supports them.
+
+The cache directory can be shared by several API workers, so the disk is
+the source of truth: hits update the access time of the file, and the
+size limit is enforced by scanning the directory and removing the least
+recently used files. Each worker scans again once it added a tenth of the
+limit, so the cache can briefly exceed it by that much per worker.
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from settings import (
+    S3_BUCKET_NAME, MEDIA_CHUNK_SIZE, MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES,
+    MEDIA_CACHE_MAX_OBJECT_SIZE,
+)
+
+# Logs
+logger = logging.getLogger(__name__)
+
+# Temporary files older than this (in seconds) are leftovers of interrupted fills
+STALE_TMP_SEC = 60 * 60
+
+# Max number of keys remembered as too big to cache
+MAX_TOO_LARGE_KEYS = 10000
+
+# Size of the cache directory at the last scan, and bytes added since
+_total_size = 0
+_added_size = 0
+_scan_lock = None
+
+# Keys too big to cache (e.g. videos), least recently seen first
+_too_large = OrderedDict()
+
+# Fills in progress (name -> future)
+_inflight = {}
+
+def cache_enabled() -> bool:
+    return bool(MEDIA_CACHE_DIR)
+
+def _cache_path(name: str) -> str:
+    return os.path.join(MEDIA_CACHE_DIR, name[:2], name)
+
+def _scan() -> int:
+    """
+    Scans the cache directory, removing the least recently used files
+    until it fits in MEDIA_CACHE_MAX_BYTES.
+
+    Returns:
+        int: Size of the cache directory
+    """
+    files = []
+    now = time.time()
+    for root, _, names in os.walk(MEDIA_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith(".tmp"):
+                    # Leftover of an interrupted fill (other workers may be filling)
+                    if now - stat.st_mtime > STALE_TMP_SEC:
+                        os.remove(path)
+                    continue
+            except FileNotFoundError:
+                # Removed by another worker
+                continue
+            files.append((stat.st_atime, path, stat.st_size))
+    total = sum(size for _, _, size in files)
+    for _, path, size in sorted(files):
+        if total <= MEDIA_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
+
+def init_media_cache() -> None:
+    """
+    Creates the cache directory and evicts files over the size limit.
+    Must be called once on startup.
+    """
+    global _total_size
+    if not cache_enabled():
+        return
+    os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
+    _total_size = _scan()
+    logger.info(f'Media cache: {_total_size} bytes')
+
+async def _evict() -> None:
+    global _total_size, _added_size, _scan_lock
+    if _scan_lock is None:
+        _scan_lock = asyncio.Lock()
+    if _scan_lock.locked():
+        return
+    async with _scan_lock:
+        _added_size = 0
+        _total_size = await asyncio.to_thread(_scan)
+
+def _is_too_large(key: str, size: int) -> bool:
+    if size > MEDIA_CACHE_MAX_OBJECT_SIZE or size > MEDIA_CACHE_MAX_BYTES:
+        _too_large[key] = True
+        if len(_too_large) > MAX_TOO_LARGE_KEYS:
+            _too_large.popitem(last=False)
+        return True
+    return False
+
+async def _fill(s3, key: str, name: str) -> str | None:
+    global _total_size, _added_size
+    # Big files (e.g. videos) are streamed from S3 instead, check the
+    # size first so they aren't downloaded just to be discarded
+    if key in _too_large:
+        _too_large.move_to_end(key)
+        return None
+    try:
+        head = await s3.head_object(Bucket=S3_BUCKET_NAME, Key=key)
+    except ClientError:
+        return None
+    if _is_too_large(key, head["ContentLength"]):
+        return None
+    try:
+        resp = await s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+    except ClientError:
+        return None
+    async with resp["Body"] as body:
+        size = resp["ContentLength"]
+        if _is_too_large(key, size):
+            return None
+        path = _cache_path(name)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            f = await asyncio.to_thread(open, tmp_path, "wb")
+            try:
+                async for chunk in body.iter_chunks(MEDIA_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                f.close()
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    _total_size += size
+    _added_size += size
+    if _total_size > MEDIA_CACHE_MAX_BYTES or _added_size > MEDIA_CACHE_MAX_BYTES // 10:
+        await _evict()
+    return path
+
+def _touch(path: str) -> bool:
+    # Marks a cached file as recently used, keeping its modification time
+    try:
+        stat = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        return True
+    except FileNotFoundError:
+        return False
+
+async def get_cached_media(s3, key: str) -> str | None:
+    """
+    Returns the path of a cached media file, filling the cache from S3
+    on a miss.
+
+    Args:
+        s3: S3 client.
+        key (str): Object key of the media file
+
+    Returns:
+        str: Path of the cached file, or None if it can't be cached
+    """
+    if not cache_enabled():
+        return None
+    name = hashlib.sha256(key.encode()).hexdigest()
+
+    # Cache hit
+    path = _cache_path(name)
+    if _touch(path):
+        return path
+
+    # Wait for a fill in progress
+    if name in _inflight:
+        return await asyncio.shield(_inflight[name])
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[name] = future
+    path = None
+    try:
+        path = await _fill(s3, key, name)
+    except Exception as e:
+        logger.error(f'Media cache: failed to cache {key}: {e}')
+    finally:
+        future.set_result(path)
+        del _inflight[name]
+    return path
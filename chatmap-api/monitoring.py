@@ -0,0 +1,50 @@
+"""
+This module measures how long the event loop is blocked (e.g. by CPU-bound
+work or blocking calls), by checking how late a periodic wake-up runs.
+"""
+
+import asyncio
+import logging
+import time
+from settings import EVENT_LOOP_MONITOR_INTERVAL_MS, EVENT_LOOP_STALL_MS
+
+# Logs
+logger = logging.getLogger(__name__)
+
+# Event loop metrics (delays in milliseconds)
+_metrics = {
+    "stalls": 0,
+    "stall_ms_total": 0,
+    "max_lag_ms": 0,
+    "last_lag_ms": 0,
+}
+
+async def monitor_event_loop() -> None:
+    """
+    Runs forever, sleeping EVENT_LOOP_MONITOR_INTERVAL_MS at a time.
+    Any extra delay before waking up is time the event loop was busy,
+    and delays of at least EVENT_LOOP_STALL_MS are counted as stalls.
+    """
+    interval = EVENT_LOOP_MONITOR_INTERVAL_MS / 1000
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag_ms = int((time.monotonic() - start - interval) * 1000)
+        _metrics["last_lag_ms"] = lag_ms
+        _metrics["max_lag_ms"] = max(_metrics["max_lag_ms"], lag_ms)
+        if lag_ms >= EVENT_LOOP_STALL_MS:
+            _metrics["stalls"] += 1
+            _metrics["stall_ms_total"] += lag_ms
+            logger.debug(f"Event loop stalled for {lag_ms} ms")
+
+def event_loop_metrics() -> dict:
+    """
+    Returns the event loop stall metrics.
+
+    Returns:
+        dict: Number of stalls, total stall time, max and last delay (in ms)
+    """
+    return {
+        "interval_ms": EVENT_LOOP_MONITOR_INTERVAL_MS,
+        **_metrics,
+    }
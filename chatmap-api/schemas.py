@@ -100,5 +100,23 @@ class SaveMediaResponse(BaseModel):
     uri: str
 
 
+class SaveMediaBatchItem(BaseModel):
+    """
+    Result of a single file in a batch media upload.
+    uri is empty if the upload failed, with the reason in error.
+    """
+    filename: str
+    uri: str | None = None
+    error: str | None = None
+
+
+class SaveMediaBatchResponse(BaseModel):
+    files: List[SaveMediaBatchItem]
+
+
+class SessionRetention(BaseModel):
+    minutes: int
+
+
 class PointTags(BaseModel):
     tags: str = ""
@@ -1,4 +1,5 @@
 import os
+import socket
 
 # Media
 MEDIA_FOLDER="media"
@@ -19,12 +20,17 @@ CHATMAP_ENC_KEY = os.getenv("CHATMAP_ENC_KEY", "0123456789ABCDEF0123456789ABCDEF
 
 # Redis
 STREAM_KEY = "messages"
-CONSUMER_GROUP = "messages-proc"
-CONSUMER_NAME = "messages-01"
+CONSUMER_GROUP = os.getenv("CHATMAP_CONSUMER_GROUP", "messages-proc")
+# Must be unique per worker process
+CONSUMER_NAME = os.getenv("CHATMAP_CONSUMER_NAME", f"{socket.gethostname()}-{os.getpid()}")
 
-# Expiring time for messages (in minutes)
+# Expiring time for messages (in minutes), can be changed per session
+# up to STREAM_MAX_RETENTION_MIN. Messages are never removed before the
+# pairing window (time tolerance of the ChatMap parser) is over
 EXPIRING_MIN = int(os.getenv("CHATMAP_EXPIRING_MIN", 30))
 EXPIRING_MIN_MS = EXPIRING_MIN * 60 * 1000
+STREAM_MAX_RETENTION_MIN = int(os.getenv("CHATMAP_STREAM_MAX_RETENTION_MIN", 6 * 60))
+PAIRING_WINDOW_MS = 30 * 60 * 1000
 
 # Database
 CHATMAP_DB = os.getenv("CHATMAP_DB", "chatmap")
@@ -33,9 +39,75 @@ CHATMAP_DB_PASSWORD = os.getenv("CHATMAP_DB_PASSWORD", "0123456789ABCDEF01234567
 CHATMAP_DB_PORT = os.getenv("CHATMAP_DB_PORT", 5432)
 CHATMAP_DB_HOST = os.getenv("CHATMAP_DB_HOST", "localhost")
 
+# Read replica (optional, falls back to the primary database)
+CHATMAP_DB_REPLICA_HOST = os.getenv("CHATMAP_DB_REPLICA_HOST", "")
+CHATMAP_DB_REPLICA_PORT = os.getenv("CHATMAP_DB_REPLICA_PORT", CHATMAP_DB_PORT)
+
+# Time (in seconds) an owner keeps reading from the primary after a write
+READ_YOUR_WRITES_SEC = int(os.getenv("CHATMAP_READ_YOUR_WRITES_SEC", 10))
+
 # Stream listener time
 STREAM_LISTENER_TIME = int(os.getenv("CHATMAP_STREAM_LISTENER_TIME", 10))
+# Run the stream listener in the API process (disable when running worker.py)
+STREAM_LISTENER_ENABLED = (os.getenv('CHATMAP_STREAM_LISTENER_ENABLED', 'true').lower() == 'true')
+# Max time (in seconds) to finish in-flight sessions on shutdown
+STREAM_DRAIN_TIMEOUT = int(os.getenv("CHATMAP_STREAM_DRAIN_TIMEOUT", 30))
 DISABLE_STREAM_CLEANUP = (os.getenv('CHATMAP_DISABLE_STREAM_CLEANUP', 'false').lower() == 'true')
+# Stream consumers (blocking read timeout, max entries read per session
+# and pass, and idle time before pending entries of a crashed consumer are
+# claimed, in milliseconds)
+STREAM_BLOCK_MS = int(os.getenv("CHATMAP_STREAM_BLOCK_MS", 5000))
+STREAM_READ_COUNT = int(os.getenv("CHATMAP_STREAM_READ_COUNT", 200))
+STREAM_CLAIM_IDLE_MS = int(os.getenv("CHATMAP_STREAM_CLAIM_IDLE_MS", 60000))
+# Consumers idle for this long (in milliseconds) without pending entries
+# are removed from the consumer groups (e.g. workers that were replaced)
+STREAM_CONSUMER_IDLE_MS = int(os.getenv("CHATMAP_STREAM_CONSUMER_IDLE_MS", 60 * 60 * 1000))
+# Deliveries of an entry before it's moved to the session's dead-letter stream
+STREAM_MAX_DELIVERIES = int(os.getenv("CHATMAP_STREAM_MAX_DELIVERIES", 5))
+# Session ownership lease (in milliseconds), renewed every third of it.
+# Sessions are spread across workers, and taken over when a worker stops
+STREAM_LEASE_MS = int(os.getenv("CHATMAP_STREAM_LEASE_MS", 30000))
+# Max time (in milliseconds) between reads of a session without new messages
+STREAM_IDLE_BACKOFF_MAX_MS = int(os.getenv("CHATMAP_STREAM_IDLE_BACKOFF_MAX_MS", 30000))
+# Sessions processed at the same time, and max processing time (in seconds)
+# for a session before its entries are left to be claimed again
+STREAM_CONCURRENCY = int(os.getenv("CHATMAP_STREAM_CONCURRENCY", 8))
+STREAM_SESSION_TIMEOUT = int(os.getenv("CHATMAP_STREAM_SESSION_TIMEOUT", 120))
+# Pool for parsing and decrypting messages off the event loop ("thread" or "process")
+INGEST_EXECUTOR = os.getenv("CHATMAP_INGEST_EXECUTOR", "thread").lower()
+INGEST_WORKERS = int(os.getenv("CHATMAP_INGEST_WORKERS", 2))
+# Media downloads from the IM connector during ingestion (parallel downloads,
+# retries with exponential backoff and timeout in seconds)
+MEDIA_INGEST_CONCURRENCY = int(os.getenv("CHATMAP_MEDIA_INGEST_CONCURRENCY", 8))
+MEDIA_INGEST_RETRIES = int(os.getenv("CHATMAP_MEDIA_INGEST_RETRIES", 3))
+MEDIA_INGEST_TIMEOUT = int(os.getenv("CHATMAP_MEDIA_INGEST_TIMEOUT", 60))
+# Event loop monitor (check interval, and min delay counted as a stall, in ms)
+EVENT_LOOP_MONITOR_INTERVAL_MS = int(os.getenv("CHATMAP_EVENT_LOOP_MONITOR_INTERVAL_MS", 500))
+EVENT_LOOP_STALL_MS = int(os.getenv("CHATMAP_EVENT_LOOP_STALL_MS", 100))
+# Sessions without messages for this long (in milliseconds) are not read.
+# Must be longer than the retention, so the last messages are removed
+STREAM_SESSION_IDLE_MS = int(os.getenv(
+    "CHATMAP_STREAM_SESSION_IDLE_MS",
+    2 * max(EXPIRING_MIN, STREAM_MAX_RETENTION_MIN) * 60 * 1000,
+))
+
+# Background map deletion (batch sizes and retry interval in seconds)
+MAP_PURGE_MEDIA_BATCH = min(int(os.getenv("CHATMAP_MAP_PURGE_MEDIA_BATCH", 1000)), 1000)
+MAP_PURGE_POINTS_BATCH = int(os.getenv("CHATMAP_MAP_PURGE_POINTS_BATCH", 5000))
+MAP_PURGE_INTERVAL = int(os.getenv("CHATMAP_MAP_PURGE_INTERVAL", 60))
+# How long (in seconds) deleted maps are reported as deleted to their owner
+MAP_DELETION_STATUS_TTL = int(os.getenv("CHATMAP_MAP_DELETION_STATUS_TTL", 24 * 60 * 60))
+
+# Exports (media files fetched in parallel, and max size to prefetch in memory)
+EXPORT_PREFETCH = int(os.getenv("CHATMAP_EXPORT_PREFETCH", 8))
+EXPORT_PREFETCH_MAX_SIZE = int(os.getenv("CHATMAP_EXPORT_PREFETCH_MAX_SIZE", 8 * 1024 * 1024))
+
+# Export jobs (artifacts are cached in S3 under this prefix, job status TTL in seconds)
+EXPORT_CACHE_PREFIX = os.getenv("CHATMAP_EXPORT_CACHE_PREFIX", "exports")
+EXPORT_JOB_TTL = int(os.getenv("CHATMAP_EXPORT_JOB_TTL", 24 * 60 * 60))
+# Running export jobs hold a lock with this TTL (in seconds), renewed while the
+# job runs, so jobs of crashed workers are restarted once it expires
+EXPORT_JOB_LOCK_TTL = int(os.getenv("CHATMAP_EXPORT_JOB_LOCK_TTL", 60))
 
 # CORS setup
 CORS_ORIGINS = os.getenv("CHATMAP_CORS_ORIGINS", "localhost,127.0.0.1,http://localhost:5173").split(",")
@@ -44,3 +116,42 @@ S3_ENDPOINT_URL = os.getenv("CHATMAP_S3_ENDPOINT_URL", "http://chatmap-minio:900
 S3_BUCKET_NAME = os.getenv("CHATMAP_S3_BUCKET_NAME", "chatmapmedia")
 S3_ACCESS_KEY = os.getenv("CHATMAP_S3_ACCESS_KEY", "minioadmin")
 S3_SECRET_KEY = os.getenv("CHATMAP_S3_SECRET_KEY", "minioadmin")
+# Shared S3 client (connection pool, timeouts and retries)
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("CHATMAP_S3_MAX_POOL_CONNECTIONS", 50))
+S3_CONNECT_TIMEOUT = int(os.getenv("CHATMAP_S3_CONNECT_TIMEOUT", 5))
+S3_READ_TIMEOUT = int(os.getenv("CHATMAP_S3_READ_TIMEOUT", 60))
+S3_MAX_ATTEMPTS = int(os.getenv("CHATMAP_S3_MAX_ATTEMPTS", 3))
+S3_RETRY_MODE = os.getenv("CHATMAP_S3_RETRY_MODE", "standard")
+# Multipart uploads (part size in bytes, S3 requires at least 5 MB)
+S3_MULTIPART_PART_SIZE = max(int(os.getenv("CHATMAP_S3_MULTIPART_PART_SIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024)
+S3_MULTIPART_CONCURRENCY = int(os.getenv("CHATMAP_S3_MULTIPART_CONCURRENCY", 4))
+# Max size (in bytes) for uploaded media files
+MEDIA_MAX_UPLOAD_SIZE = int(os.getenv("CHATMAP_MEDIA_MAX_UPLOAD_SIZE", 512 * 1024 * 1024))
+# Batch media uploads (max files and total size per request, parallel S3 writes)
+MEDIA_BATCH_MAX_FILES = int(os.getenv("CHATMAP_MEDIA_BATCH_MAX_FILES", 500))
+MEDIA_BATCH_MAX_SIZE = int(os.getenv("CHATMAP_MEDIA_BATCH_MAX_SIZE", 2 * 1024 * 1024 * 1024))
+MEDIA_BATCH_CONCURRENCY = int(os.getenv("CHATMAP_MEDIA_BATCH_CONCURRENCY", 8))
+# Image derivatives (thumbnails and previews)
+MEDIA_DERIVATIVES = (os.getenv('CHATMAP_MEDIA_DERIVATIVES', 'true').lower() == 'true')
+MEDIA_DERIVATIVE_FORMAT = os.getenv("CHATMAP_MEDIA_DERIVATIVE_FORMAT", "webp").lower()
+MEDIA_DERIVATIVE_PREFIX = os.getenv("CHATMAP_MEDIA_DERIVATIVE_PREFIX", "derivatives")
+MEDIA_DERIVATIVE_WORKERS = int(os.getenv("CHATMAP_MEDIA_DERIVATIVE_WORKERS", 2))
+# Time (in seconds) the original is served instead of a derivative that
+# failed to be generated, before trying again
+MEDIA_DERIVATIVE_RETRY_SEC = int(os.getenv("CHATMAP_MEDIA_DERIVATIVE_RETRY_SEC", 300))
+# Max age (in seconds) for HTTP caching of media files, which are never overwritten
+MEDIA_MAX_AGE = int(os.getenv("CHATMAP_MEDIA_MAX_AGE", 365 * 24 * 60 * 60))
+
+# Local disk cache for hot media (disabled if no directory is set)
+MEDIA_CACHE_DIR = os.getenv("CHATMAP_MEDIA_CACHE_DIR", "")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("CHATMAP_MEDIA_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+MEDIA_CACHE_MAX_OBJECT_SIZE = int(os.getenv("CHATMAP_MEDIA_CACHE_MAX_OBJECT_SIZE", 50 * 1024 * 1024))
+# Endpoint reachable by browsers, used for presigned URLs
+S3_PUBLIC_ENDPOINT_URL = os.getenv("CHATMAP_S3_PUBLIC_ENDPOINT_URL", S3_ENDPOINT_URL)
+
+# Redirect media requests to presigned S3 URLs instead of proxying the bytes
+MEDIA_PRESIGNED_URLS = (os.getenv('CHATMAP_MEDIA_PRESIGNED_URLS', 'false').lower() == 'true')
+MEDIA_PRESIGNED_EXPIRES_SEC = int(os.getenv("CHATMAP_MEDIA_PRESIGNED_EXPIRES_SEC", 300))
+
+# Size (in bytes) of the chunks used for streaming media from S3
+MEDIA_CHUNK_SIZE = int(os.getenv("CHATMAP_MEDIA_CHUNK_SIZE", 64 * 1024))
@@ -0,0 +1,317 @@
+"""
+This module manages the S3 clients shared across the API lifecycle.
+Clients are created once on startup and closed on shutdown, so requests
+reuse pooled connections to the object store instead of creating a new
+client (and new TLS/TCP connections) every time.
+"""
+
+import asyncio
+import hashlib
+import logging
+from contextlib import AsyncExitStack
+from typing import AsyncIterator, Tuple
+from aiobotocore.session import get_session
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
+from settings import (
+    S3_ACCESS_KEY, S3_SECRET_KEY, S3_ENDPOINT_URL, S3_PUBLIC_ENDPOINT_URL,
+    S3_MAX_POOL_CONNECTIONS, S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT,
+    S3_MAX_ATTEMPTS, S3_RETRY_MODE, S3_BUCKET_NAME, S3_MULTIPART_PART_SIZE,
+    S3_MULTIPART_CONCURRENCY,
+)
+
+# Logs
+logger = logging.getLogger(__name__)
+
+# Raised when an upload exceeds the max allowed size
+class MediaTooLarge(Exception):
+    pass
+
+# Shared clients, set by start_s3()
+_stack = None
+_client = None
+_presign_client = None
+
+# Basic pool metrics. Errors are either error responses (4xx/5xx)
+# or transport errors (e.g. timeouts, connection errors)
+_metrics = {
+    "requests": 0,
+    "in_flight": 0,
+    "errors": 0,
+    "http_errors": 0,
+    "transport_errors": 0,
+}
+
+def _before_call(**kwargs):
+    _metrics["requests"] += 1
+
+def _after_call(http_response=None, **kwargs):
+    if http_response is not None and http_response.status_code >= 400:
+        _metrics["errors"] += 1
+        _metrics["http_errors"] += 1
+
+def _after_call_error(**kwargs):
+    _metrics["errors"] += 1
+    _metrics["transport_errors"] += 1
+
+def _track_in_flight(client) -> None:
+    # Counts calls in flight around the client's API calls, as botocore
+    # events aren't emitted for cancelled calls (e.g. client disconnects)
+    make_api_call = client._make_api_call
+
+    async def _make_api_call(*args, **kwargs):
+        _metrics["in_flight"] += 1
+        try:
+            return await make_api_call(*args, **kwargs)
+        finally:
+            _metrics["in_flight"] -= 1
+
+    client._make_api_call = _make_api_call
+
+async def start_s3() -> None:
+    """
+    Creates the shared S3 clients. Must be called once on startup.
+    """
+    global _stack, _client, _presign_client
+    if _client is not None:
+        return
+    session = get_session()
+
+    s3_client_kwargs = {
+        'config': AioConfig(
+            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            connect_timeout=S3_CONNECT_TIMEOUT,
+            read_timeout=S3_READ_TIMEOUT,
+            retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': S3_RETRY_MODE},
+        ),
+    }
+    if S3_ACCESS_KEY:
+        s3_client_kwargs['aws_access_key_id'] = S3_ACCESS_KEY
+    if S3_SECRET_KEY:
+        s3_client_kwargs['aws_secret_access_key'] = S3_SECRET_KEY
+
+    _stack = AsyncExitStack()
+    _client = await _stack.enter_async_context(session.create_client(
+        's3', endpoint_url=S3_ENDPOINT_URL, **s3_client_kwargs))
+    _client.meta.events.register('before-call.s3', _before_call)
+    _client.meta.events.register('after-call.s3', _after_call)
+    _client.meta.events.register('after-call-error.s3', _after_call_error)
+    _track_in_flight(_client)
+
+    # Presigned URLs are signed for the endpoint reachable by browsers
+    if S3_PUBLIC_ENDPOINT_URL != S3_ENDPOINT_URL:
+        _presign_client = await _stack.enter_async_context(session.create_client(
+            's3', endpoint_url=S3_PUBLIC_ENDPOINT_URL, **s3_client_kwargs))
+    else:
+        _presign_client = _client
+    logger.info(f'S3 client started (max pool connections: {S3_MAX_POOL_CONNECTIONS})')
+
+async def stop_s3() -> None:
+    """
+    Closes the shared S3 clients. Must be called once on shutdown.
+    """
+    global _stack, _client, _presign_client
+    if _stack is not None:
+        await _stack.aclose()
+    _stack = _client = _presign_client = None
+    logger.info('S3 client stopped')
+
+# Dependency to get the shared S3 client
+def get_s3_client():
+    """
+    Provides the shared S3 client.
+
+    Returns:
+        AioBaseClient: aiobotocore S3 client
+    """
+    if _client is None:
+        raise RuntimeError("S3 client not started")
+    return _client
+
+# Dependency to get the S3 client used for presigned URLs
+def get_s3_presign_client():
+    """
+    Provides the shared S3 client configured with the public endpoint.
+
+    Returns:
+        AioBaseClient: aiobotocore S3 client
+    """
+    if _presign_client is None:
+        raise RuntimeError("S3 client not started")
+    return _presign_client
+
+def s3_metrics() -> dict:
+    """
+    Returns basic metrics for the shared S3 client pool.
+
+    Returns:
+        dict: Pool size, total requests, in-flight requests and errors
+            (error responses and transport errors)
+    """
+    return {
+        "max_pool_connections": S3_MAX_POOL_CONNECTIONS,
+        **_metrics,
+    }
+
+async def object_exists(s3, key: str) -> bool:
+    """
+    Checks if an object exists in the bucket.
+
+    Args:
+        s3: S3 client.
+        key (str): Object key.
+
+    Returns:
+        bool: True if the object exists
+    """
+    try:
+        await s3.head_object(Bucket=S3_BUCKET_NAME, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+class AsyncIteratorReader:
+    """
+    Adapts an async iterator of bytes to a file-like object with an
+    async `read(size)` method, so it can be uploaded with `upload_fileobj`.
+    """
+    def __init__(self, iterator: AsyncIterator[bytes]):
+        self.iterator = iterator
+        self.buffer = bytearray()
+
+    async def read(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            try:
+                self.buffer += await anext(self.iterator)
+            except StopAsyncIteration:
+                break
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+async def upload_fileobj(s3, key: str, file, content_type: str | None = None, max_size: int = 0) -> int:
+    """
+    Streams a file-like object to S3. Files bigger than one part are sent
+    with a multipart upload, uploading up to S3_MULTIPART_CONCURRENCY parts
+    in parallel, so memory use is bounded to a few parts per upload.
+    Failed multipart uploads are aborted.
+
+    Args:
+        s3: S3 client.
+        key (str): Object key.
+        file: Object with an async `read(size)` method (e.g. UploadFile,
+            AsyncIteratorReader).
+        content_type (str): Content type of the object (optional)
+        max_size (int): Max allowed size in bytes (0 for no limit)
+
+    Returns:
+        int: Size of the uploaded object in bytes
+
+    Raises:
+        MediaTooLarge: If the file is bigger than max_size.
+    """
+    extra = {'ContentType': content_type} if content_type else {}
+    chunk = await file.read(S3_MULTIPART_PART_SIZE)
+    if max_size and len(chunk) > max_size:
+        raise MediaTooLarge(key)
+
+    # Small files are uploaded in a single request
+    if len(chunk) < S3_MULTIPART_PART_SIZE:
+        await s3.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=chunk, **extra)
+        return len(chunk)
+
+    mpu = await s3.create_multipart_upload(Bucket=S3_BUCKET_NAME, Key=key, **extra)
+    upload_id = mpu['UploadId']
+    semaphore = asyncio.Semaphore(S3_MULTIPART_CONCURRENCY)
+    etags = {}
+    tasks = []
+
+    async def upload_part(number: int, body: bytes):
+        try:
+            resp = await s3.upload_part(
+                Bucket=S3_BUCKET_NAME,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=number,
+                Body=body,
+            )
+            etags[number] = resp['ETag']
+        finally:
+            semaphore.release()
+
+    size = 0
+    try:
+        number = 1
+        while chunk:
+            size += len(chunk)
+            if max_size and size > max_size:
+                raise MediaTooLarge(key)
+            # Wait for a free slot before reading the next part
+            await semaphore.acquire()
+            for task in tasks:
+                if task.done() and task.exception():
+                    raise task.exception()
+            tasks.append(asyncio.create_task(upload_part(number, chunk)))
+            number += 1
+            chunk = await file.read(S3_MULTIPART_PART_SIZE)
+        await asyncio.gather(*tasks)
+        await s3.complete_multipart_upload(
+            Bucket=S3_BUCKET_NAME,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'PartNumber': number, 'ETag': etag} for number, etag in sorted(etags.items())
+            ]},
+        )
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await s3.abort_multipart_upload(Bucket=S3_BUCKET_NAME, Key=key, UploadId=upload_id)
+        logger.warning(f'Multipart upload aborted: {key}')
+        raise
+    return size
+
+def _hash_file(file, max_size: int = 0) -> str:
+    # Computes the SHA-256 of a local file, then rewinds it
+    sha256 = hashlib.sha256()
+    size = 0
+    file.seek(0)
+    while chunk := file.read(S3_MULTIPART_PART_SIZE):
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise MediaTooLarge()
+        sha256.update(chunk)
+    file.seek(0)
+    return sha256.hexdigest()
+
+async def upload_content_addressed(s3, file, suffix: str = "", content_type: str | None = None,
+                                   max_size: int = 0) -> Tuple[str, bool]:
+    """
+    Streams an uploaded file to S3 under the SHA-256 of its content, so
+    duplicated files are stored once. The hash is computed from the
+    spooled upload in a worker thread, and the file is only sent to S3
+    if its content isn't stored yet.
+
+    Args:
+        s3: S3 client.
+        file (UploadFile): Uploaded file.
+        suffix (str): Suffix for the key, e.g. the file extension (optional)
+        content_type (str): Content type of the object (optional)
+        max_size (int): Max allowed size in bytes (0 for no limit)
+
+    Returns:
+        Tuple[str, bool]: Object key, and whether it was stored (False if
+            the same content was already stored)
+
+    Raises:
+        MediaTooLarge: If the file is bigger than max_size.
+    """
+    key = await asyncio.to_thread(_hash_file, file.file, max_size) + suffix
+    if await object_exists(s3, key):
+        return key, False
+    await file.seek(0)
+    await upload_fileobj(s3, key, file, content_type=content_type, max_size=max_size)
+    return key, True
@@ -1,8 +1,13 @@
 """
 This module implements a Redis stream listener that ingests real-time instant messages 
-from Redis streams and processes them to generate maps. It continuously monitors active 
-user sessions, retrieves new message entries from their respective Redis streams, 
-and passes them to the processing function for map creation and data updates. 
+from Redis streams and processes them to generate maps. Each user session has its own
+stream, read through a consumer group with blocking reads, so new messages are
+processed as soon as they arrive. Entries are acknowledged once their points are
+stored, and entries left pending by a crashed consumer are claimed and processed again.
+Entries that keep failing are moved to a dead-letter stream.
+
+Sessions are spread across workers with Redis leases, so each session's stream is
+processed by a single worker at a time, and rebalanced when workers join or leave.
 
 The module also includes automatic cleanup of old messages from streams based on a 
 configured expiration time.
@@ -14,8 +19,17 @@ import time
 import os
 import logging
 import asyncio
-from data import process_chat_entries
-from settings import STREAM_KEY, EXPIRING_MIN_MS, STREAM_LISTENER_TIME, DISABLE_STREAM_CLEANUP
+import math
+from data import process_chat_entries, parse_chat_entries, parse_stream_id
+from typing import Dict, List, Tuple
+from settings import (
+    STREAM_KEY, EXPIRING_MIN_MS, STREAM_LISTENER_TIME, DISABLE_STREAM_CLEANUP,
+    CONSUMER_GROUP, CONSUMER_NAME, STREAM_BLOCK_MS, STREAM_READ_COUNT,
+    STREAM_CLAIM_IDLE_MS, STREAM_LEASE_MS, STREAM_SESSION_IDLE_MS,
+    PAIRING_WINDOW_MS, STREAM_CONCURRENCY, STREAM_SESSION_TIMEOUT,
+    STREAM_IDLE_BACKOFF_MAX_MS, STREAM_MAX_DELIVERIES, STREAM_MAX_RETENTION_MIN,
+    STREAM_CONSUMER_IDLE_MS,
+)
 
 # Logs
 logger = logging.getLogger(__name__)
@@ -25,71 +39,771 @@ redis_host = os.getenv("REDIS_HOST", "localhost")
 redis_port = int(os.getenv("REDIS_PORT", 6379))
 redis_client = redis.Redis(host=redis_host, port=redis_port, db=0)
 
+# Streams with a consumer group already created by this worker
+_groups = set()
+
+# Session registry: sessions scored by the time of their last message (ms),
+# maintained by the IM connector and clean_user_stream
+SESSIONS_KEY = "sessions"
+
+# Retention (in ms) of each session's messages, if not EXPIRING_MIN_MS
+RETENTION_KEY = "stream_retention"
+
+# Last processed entry ID of each session
+CHECKPOINT_KEY = "stream_checkpoint"
+
+# Session ownership: live workers (sorted by last heartbeat) and
+# one lease per session, holding the name of the worker that owns it
+WORKERS_KEY = "stream_workers"
+LEASE_KEY = "stream_lease"
+
+# Entries that failed STREAM_MAX_DELIVERIES times are moved to the
+# session's dead-letter stream, keeping its last entries
+DEAD_LETTER_SUFFIX = "dead"
+DEAD_LETTER_MAXLEN = 1000
+
+# Sessions owned by this worker
+_owned = []
+
+# Scheduling state of each owned session: time of the last message seen
+# (from the registry), whether entries were left unread by the per-pass
+# budget, consecutive reads without entries, and next read if idle
+_schedule = {}
+
+# Pairing lookback of each owned session, kept across batches so each
+# entry is read and parsed once: start of the lookback (ms), parsed entries
+# (entry ID, message) in stream order, and locations stored with the ID of
+# the message they were paired with
+_lookback = {}
+
+# Sessions being processed, and limit of sessions processed at the same time
+_in_flight = {}
+_semaphore = asyncio.Semaphore(STREAM_CONCURRENCY)
+
+# Initial time between reads of an idle session (doubles up to
+# STREAM_IDLE_BACKOFF_MAX_MS), and max blocking time while sessions are
+# being processed (to start the next pass of a session without delay)
+IDLE_BACKOFF_MS = 1000
+BUSY_BLOCK_MS = 100
+
+# Renew or release a lease only if it's still held by this worker
+_renew_lease = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+_release_lease = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+# Remove a consumer only if it has no pending entries (they would be lost)
+_delete_consumer = redis_client.register_script("""
+if #redis.call('xpending', KEYS[1], ARGV[1], '-', '+', 1, ARGV[2]) == 0 then
+    return redis.call('xgroup', 'delconsumer', KEYS[1], ARGV[1], ARGV[2])
+end
+return -1
+""")
+
 # Cleanup all messages for an user
 async def clean_user_stream(user: str):
-    await redis_client.delete(f"{STREAM_KEY}:{user}")
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(f"{STREAM_KEY}:{user}")
+        pipe.delete(f"{STREAM_KEY}:{user}:{DEAD_LETTER_SUFFIX}")
+        pipe.zrem(SESSIONS_KEY, user)
+        pipe.hdel(CHECKPOINT_KEY, user)
+        await pipe.execute()
+    _groups.discard(user)
+    _lookback.pop(user, None)
     logger.info(f'cleanup: all messages deleted for user {user}')
 
+# Set the retention of a session's messages
+async def set_session_retention(user: str, minutes: int) -> None:
+    """
+    Sets how long the messages of a session are kept in its stream.
+
+    Args:
+        user (str): The identifier of the user session.
+        minutes (int): Retention in minutes.
+    """
+    await redis_client.hset(RETENTION_KEY, user, minutes * 60 * 1000)
+
 # Cleanup old messages
-async def cleanup(user: str):
+async def cleanup(sessions: List[str]) -> None:
     """
-    Removes old entries from a Redis stream for a given user.
-    
-    The function calculates a cutoff time based on the current time minus the 
-    expiration threshold (EXPIRING_MIN_MS). It then deletes all entries in the 
-    stream that are older than this cutoff.
+    Removes old entries from the Redis streams of a list of sessions,
+    with a constant number of round trips.
+
+    The cutoff of each stream is the current time minus its retention
+    (EXPIRING_MIN_MS unless set per session), never less than the pairing
+    window, so content is kept until any location it could be paired with
+    has arrived. Entries not processed yet (not delivered to, or pending in,
+    the consumer group) are kept too, up to STREAM_MAX_RETENTION_MIN, so
+    the stream of a session that is never processed doesn't grow without
+    bound. Streams are trimmed server-side with exact XTRIM MINID in a
+    single pipeline (approximate trimming only removes whole macro nodes,
+    so it never trims small streams).
+
+    Sessions without messages in the last STREAM_SESSION_IDLE_MS
+    milliseconds are also removed from the session registry, so it
+    doesn't grow with every session ever seen. Likewise, consumers idle
+    for STREAM_CONSUMER_IDLE_MS without pending entries (e.g. workers
+    that were restarted under a new name) are removed from the groups.
 
     Args:
-        user (str): The identifier of the user whose stream will be cleaned up.
+        sessions (List[str]): The identifiers of the user sessions.
     """
-    cutoff_time_ms = int(time.time() * 1000) - EXPIRING_MIN_MS
-    cutoff_id = f"{cutoff_time_ms}-0"
-    entries = await redis_client.xrange(f"{STREAM_KEY}:{user}", min='-', max=cutoff_id)
-    # Remove data older than (EXPIRING_MIN_MS) minutes
-    for entry_id, _ in entries:
-        await redis_client.xdel(f"{STREAM_KEY}:{user}", entry_id)
-    logger.info(f'cleanup: {len(entries)} messages deleted')
+    now = int(time.time() * 1000)
+    retentions, results = [], []
+    if sessions:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hmget(RETENTION_KEY, sessions)
+            for user in sessions:
+                pipe.xinfo_groups(f"{STREAM_KEY}:{user}")
+                pipe.xpending(f"{STREAM_KEY}:{user}", CONSUMER_GROUP)
+                pipe.xinfo_consumers(f"{STREAM_KEY}:{user}", CONSUMER_GROUP)
+            retentions, *results = await pipe.execute(raise_on_error=False)
 
-# Get all sessions
-async def get_sessions():
+    cutoffs = {}
+    stale = []
+    for index, user in enumerate(sessions):
+        groups, pending, consumers = results[3 * index:3 * index + 3]
+        if not isinstance(consumers, Exception):
+            stale += [
+                (user, consumer["name"]) for consumer in consumers
+                if consumer["pending"] == 0 and consumer["idle"] > STREAM_CONSUMER_IDLE_MS
+                and consumer["name"].decode("utf-8") != CONSUMER_NAME
+            ]
+        if isinstance(groups, Exception) or isinstance(pending, Exception):
+            continue
+        group = next((g for g in groups if g["name"].decode("utf-8") == CONSUMER_GROUP), None)
+        if group is None:
+            continue
+        retention = int(retentions[index]) if retentions[index] else EXPIRING_MIN_MS
+        cutoff = now - max(retention, PAIRING_WINDOW_MS)
+        # Keep entries not processed yet, up to the max retention
+        unprocessed = parse_stream_id(group["last-delivered-id"])[0]
+        if pending["min"]:
+            unprocessed = min(unprocessed, parse_stream_id(pending["min"])[0])
+        oldest = now - max(STREAM_MAX_RETENTION_MIN * 60 * 1000, PAIRING_WINDOW_MS)
+        cutoffs[user] = min(cutoff, max(unprocessed, oldest))
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zremrangebyscore(SESSIONS_KEY, "-inf", f"({now - STREAM_SESSION_IDLE_MS}")
+        for user, consumer in stale:
+            await _delete_consumer(keys=[f"{STREAM_KEY}:{user}"], args=[CONSUMER_GROUP, consumer], client=pipe)
+        for user, cutoff in cutoffs.items():
+            pipe.xtrim(f"{STREAM_KEY}:{user}", minid=f"{cutoff}-0", approximate=False)
+        pruned, *results = await pipe.execute(raise_on_error=False)
+    removed = sum(1 for count in results[:len(stale)] if isinstance(count, int) and count >= 0)
+    deleted = sum(count for count in results[len(stale):] if isinstance(count, int))
+    logger.info(f'cleanup: {deleted} messages deleted')
+    if isinstance(pruned, int) and pruned:
+        logger.info(f'cleanup: {pruned} idle sessions removed from the registry')
+    if removed:
+        logger.info(f'cleanup: {removed} idle consumers removed')
+
+# Get active sessions
+async def get_sessions() -> Dict[str, int]:
     """
-    Retrieves all active user sessions from Redis by scanning for keys matching 
-    the pattern 'messages:*' which represent streams for individual users.
+    Retrieves the active user sessions from the session registry: sessions
+    with messages in the last STREAM_SESSION_IDLE_MS milliseconds.
 
     Returns:
-        list: A list of user identifiers (strings) corresponding to active sessions.
+        Dict[str, int]: User identifiers of the active sessions, with the
+            time of their last message (Unix ms).
+    """
+    since = int(time.time() * 1000) - STREAM_SESSION_IDLE_MS
+    keys = await redis_client.zrangebyscore(SESSIONS_KEY, since, "+inf", withscores=True)
+    return {key.decode("utf-8"): int(score) for key, score in keys}
+
+async def register_sessions() -> None:
+    """
+    Adds existing streams missing from the session registry (e.g. written
+    by an older IM connector) by scanning the keyspace once. Each session
+    is scored by the time of its last entry, so idle sessions removed by
+    `cleanup` aren't registered as active again.
+    """
+    keys = [key async for key in redis_client.scan_iter(match=f"{STREAM_KEY}:*", type="stream")]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.xrevrange(key, count=1)
+        results = await pipe.execute(raise_on_error=False)
+    sessions = {
+        key.decode("utf-8").replace(f"{STREAM_KEY}:", "", 1): parse_stream_id(entries[0][0])[0]
+        for key, entries in zip(keys, results)
+        if entries and not isinstance(entries, Exception)
+        and not key.decode("utf-8").endswith(f":{DEAD_LETTER_SUFFIX}")
+    }
+    if sessions:
+        await redis_client.zadd(SESSIONS_KEY, sessions, nx=True)
+    logger.info(f"{len(sessions)} sessions in the registry")
+
+async def assign_sessions(sessions: List[str]) -> List[str]:
+    """
+    Sends this worker's heartbeat and rebalances session ownership.
+    Each session is owned by a single worker through a lease that
+    expires after STREAM_LEASE_MS, so sessions of a worker that stops
+    are taken over by the others.
+
+    Every worker owns up to its fair share of sessions (sessions / live
+    workers): it renews its leases, releases the ones above its share
+    (e.g. a new worker joined) and acquires free sessions below it.
+    Sessions being processed are kept until they're done, so a session
+    is never processed by two workers at the same time.
+
+    Args:
+        sessions (List[str]): The identifiers of all active user sessions.
+
+    Returns:
+        List[str]: Sessions owned by this worker.
+    """
+    global _owned
+    now = int(time.time() * 1000)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zadd(WORKERS_KEY, {CONSUMER_NAME: now})
+        pipe.zremrangebyscore(WORKERS_KEY, 0, now - STREAM_LEASE_MS)
+        pipe.zcard(WORKERS_KEY)
+        for user in sessions:
+            pipe.get(f"{LEASE_KEY}:{user}")
+        _, _, workers, *owners = await pipe.execute()
+
+    share = math.ceil(len(sessions) / max(workers, 1))
+    owner_name = CONSUMER_NAME.encode("utf-8")
+    mine = [user for user, owner in zip(sessions, owners) if owner == owner_name]
+    free = [user for user, owner in zip(sessions, owners) if owner is None]
+    # Release sessions above the share, but not while being processed
+    # (including sessions no longer active)
+    mine += [user for user in _in_flight if user not in sessions]
+    mine.sort(key=lambda user: user not in _in_flight)
+    extra = [user for user in mine[share:] if user not in _in_flight]
+    mine = [user for user in mine if user not in extra]
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for user in mine:
+            await _renew_lease(keys=[f"{LEASE_KEY}:{user}"], args=[CONSUMER_NAME, STREAM_LEASE_MS], client=pipe)
+        for user in extra:
+            await _release_lease(keys=[f"{LEASE_KEY}:{user}"], args=[CONSUMER_NAME], client=pipe)
+        candidates = free[:max(share - len(mine), 0)]
+        for user in candidates:
+            pipe.set(f"{LEASE_KEY}:{user}", CONSUMER_NAME, nx=True, px=STREAM_LEASE_MS)
+        results = await pipe.execute()
+
+    renewed = results[:len(mine)]
+    acquired = results[len(mine) + len(extra):]
+    owned = [user for user, ok in zip(mine, renewed) if ok]
+    owned += [user for user, ok in zip(candidates, acquired) if ok]
+    if set(owned) != set(_owned):
+        logger.info(f"Owning {len(owned)} of {len(sessions)} sessions ({workers} workers)")
+    _owned = owned
+    return owned
+
+async def renew_leases() -> None:
+    """
+    Sends this worker's heartbeat and renews the leases of its sessions,
+    dropping the sessions whose lease was lost (e.g. it expired and was
+    taken over by another worker).
+    """
+    global _owned
+    owned = list(_owned)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zadd(WORKERS_KEY, {CONSUMER_NAME: int(time.time() * 1000)})
+        for user in owned:
+            await _renew_lease(keys=[f"{LEASE_KEY}:{user}"], args=[CONSUMER_NAME, STREAM_LEASE_MS], client=pipe)
+        _, *renewed = await pipe.execute()
+    lost = {user for user, ok in zip(owned, renewed) if not ok}
+    if lost:
+        logger.warning(f"Lost the lease of {len(lost)} sessions")
+        _owned = [user for user in _owned if user not in lost]
+
+async def lease_heartbeat() -> None:
+    """
+    Renews this worker's leases every third of STREAM_LEASE_MS, apart
+    from the listener loop, so leases don't expire while the loop is
+    busy (e.g. claiming or cleaning up streams) or sessions take longer
+    than a lease to process.
+    """
+    while True:
+        await asyncio.sleep(STREAM_LEASE_MS / 3000)
+        try:
+            await renew_leases()
+        except Exception as e:
+            logger.warning(f"Failed to renew leases: {e}")
+
+async def release_sessions() -> None:
+    """
+    Releases all the sessions owned by this worker and removes its
+    heartbeat, so other workers can take them over right away.
+    """
+    global _owned
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for user in _owned:
+            await _release_lease(keys=[f"{LEASE_KEY}:{user}"], args=[CONSUMER_NAME], client=pipe)
+        pipe.zrem(WORKERS_KEY, CONSUMER_NAME)
+        await pipe.execute()
+    _owned = []
+
+async def ensure_group(user: str) -> None:
+    """
+    Creates the consumer group for a session stream, if it doesn't exist.
+    New groups start at the beginning of the stream, so entries added
+    before the group was created are processed too.
+
+    Args:
+        user (str): The identifier of the user session.
+    """
+    if user in _groups:
+        return
+    try:
+        await redis_client.xgroup_create(f"{STREAM_KEY}:{user}", CONSUMER_GROUP, id="0")
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    _groups.add(user)
+
+async def read_entries(sessions: List[str], block: int | None = STREAM_BLOCK_MS) -> Dict[str, list]:
+    """
+    Reads new entries for a list of sessions with a single XREADGROUP call,
+    up to STREAM_READ_COUNT entries per session. If block is set, returns
+    as soon as any stream has new entries, or after block milliseconds.
+
+    Args:
+        sessions (List[str]): The identifiers of the user sessions.
+        block (int | None): Max time to wait for new entries (ms), or None.
+
+    Returns:
+        Dict[str, list]: New entries for each session.
+    """
+    streams = {f"{STREAM_KEY}:{user}": ">" for user in sessions}
+    try:
+        response = await redis_client.xreadgroup(
+            CONSUMER_GROUP,
+            CONSUMER_NAME,
+            streams,
+            count=STREAM_READ_COUNT,
+            block=block,
+        )
+    except redis.ResponseError as e:
+        # A stream was deleted and created again without its group
+        if "NOGROUP" in str(e):
+            _groups.clear()
+            return {}
+        raise
+    return {
+        key.decode("utf-8").replace(f"{STREAM_KEY}:", "", 1): entries
+        for key, entries in response or []
+        if entries
+    }
+
+async def dead_letter(user: str, entry_ids: List[bytes]) -> None:
+    """
+    Moves entries of a session to its dead-letter stream: each entry is
+    copied (with its original ID in the "entry_id" field), acknowledged
+    and deleted from the session stream, so it's neither claimed again nor
+    read in the pairing lookback of the next entries.
+
+    Args:
+        user (str): The identifier of the user session.
+        entry_ids (List[bytes]): IDs of the entries to move.
     """
-    keys = []
-    async for key in redis_client.scan_iter(match="messages:*", type="stream"):
-        keys.append(key.decode("utf-8").replace("messages:", ""))
-    return keys
+    key = f"{STREAM_KEY}:{user}"
+    dead_key = f"{key}:{DEAD_LETTER_SUFFIX}"
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for entry_id in entry_ids:
+            pipe.xrange(key, min=entry_id, max=entry_id)
+        results = await pipe.execute()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        for entry_id, entries in zip(entry_ids, results):
+            if entries:
+                pipe.xadd(dead_key, {**entries[0][1], "entry_id": entry_id}, maxlen=DEAD_LETTER_MAXLEN)
+        pipe.pexpire(dead_key, STREAM_SESSION_IDLE_MS)
+        pipe.xack(key, CONSUMER_GROUP, *entry_ids)
+        pipe.xdel(key, *entry_ids)
+        await pipe.execute()
+    _lookback.pop(user, None)
+    logger.warning(
+        f"{len(entry_ids)} entries for user {user} failed {STREAM_MAX_DELIVERIES} times, "
+        f"moved to {dead_key}: {', '.join(entry_id.decode('utf-8') for entry_id in entry_ids)}"
+    )
 
-async def stream_listener() -> None:
+async def claim_entries(user: str) -> list:
     """
-    Main asynchronous listener loop that periodically processes Redis streams 
-    for all active user sessions. For each session, it retrieves new messages 
-    from the stream and passes them to `process_chat_entries` for further handling.
+    Claims entries that were delivered to a consumer but not acknowledged
+    within STREAM_CLAIM_IDLE_MS milliseconds (e.g. the consumer crashed,
+    or processing failed), so they are processed again by this consumer.
 
-    Additionally, this function cleans up old messages from each stream if 
+    Entries already delivered STREAM_MAX_DELIVERIES times (e.g. messages
+    the parser fails on) are moved to the dead-letter stream instead (see
+    `dead_letter`), so they don't fail every later batch.
+
+    Args:
+        user (str): The identifier of the user session.
+
+    Returns:
+        list: Claimed entries (up to STREAM_READ_COUNT).
+    """
+    key = f"{STREAM_KEY}:{user}"
+    pending = await redis_client.xpending_range(
+        key,
+        CONSUMER_GROUP,
+        min="-",
+        max="+",
+        count=STREAM_READ_COUNT,
+        idle=STREAM_CLAIM_IDLE_MS,
+    )
+    failed = [entry["message_id"] for entry in pending if entry["times_delivered"] >= STREAM_MAX_DELIVERIES]
+    if failed:
+        await dead_letter(user, failed)
+
+    response = await redis_client.xautoclaim(
+        key,
+        CONSUMER_GROUP,
+        CONSUMER_NAME,
+        min_idle_time=STREAM_CLAIM_IDLE_MS,
+        start_id="0-0",
+        count=STREAM_READ_COUNT,
+    )
+    entries = response[1] if response else []
+    # Entries deleted from the stream while pending can't be processed
+    deleted = [entry_id for entry_id, fields in entries if not fields]
+    if deleted:
+        await redis_client.xack(key, CONSUMER_GROUP, *deleted)
+    return [(entry_id, fields) for entry_id, fields in entries if fields]
+
+async def read_lookback(user: str, start_ms: int, last_id: bytes) -> Tuple[List[Dict], Dict[str, str]]:
+    """
+    Returns the parsed messages of a session from start_ms up to an entry,
+    for pairing. Messages are kept across batches (see `_lookback`), so
+    only entries after the last one read are fetched from the stream and
+    parsed, instead of the whole lookback on every batch. Messages older
+    than start_ms are dropped.
+
+    Args:
+        user (str): The identifier of the user session.
+        start_ms (int): Start of the lookback (Unix ms).
+        last_id (bytes): ID of the last entry to return.
+
+    Returns:
+        Tuple[List[Dict], Dict[str, str]]: Chat messages, in stream order,
+            and the locations stored from them, with the ID of the message
+            they were paired with.
+    """
+    lookback = _lookback.get(user)
+    if lookback is None or lookback["since"] > start_ms:
+        # Older entries are needed (e.g. claimed entries), read them all again
+        lookback = {"since": start_ms, "entries": [], "stored": {}}
+        _lookback[user] = lookback
+    entries, stored = lookback["entries"], lookback["stored"]
+    expired = 0
+    while expired < len(entries) and parse_stream_id(entries[expired][0])[0] < start_ms:
+        stored.pop(entries[expired][1]["id"], None)
+        expired += 1
+    del entries[:expired]
+    lookback["since"] = start_ms
+
+    last = parse_stream_id(last_id)
+    if not entries or parse_stream_id(entries[-1][0]) < last:
+        new_entries = await redis_client.xrange(
+            f"{STREAM_KEY}:{user}",
+            min=b"(" + entries[-1][0] if entries else f"{start_ms}-0",
+            max=last_id,
+        )
+        messages = await parse_chat_entries(new_entries)
+        entries.extend(zip((entry_id for entry_id, _ in new_entries), messages))
+    messages = [message for entry_id, message in entries if parse_stream_id(entry_id) <= last]
+    return messages, stored
+
+async def process_session(user: str, new_entries: list, claimed: List[str] = ()) -> None:
+    """
+    Processes the new entries of a session and acknowledges them.
+
+    The session checkpoint is a watermark: every entry up to it was
+    processed and acknowledged. Entries up to it are only acknowledged,
+    e.g. entries read again after the consumer group was created anew.
+    Claimed entries are always processed. Only locations that could be
+    paired with new entries (sent within the pairing window of them) are
+    stored again, paired using the entries up to two pairing windows
+    before them, as the location and the content of a point can arrive
+    in different entries. The lookback is kept across batches (see
+    `read_lookback`), and locations whose pairing didn't change since
+    they were stored are skipped.
+
+    The checkpoint only moves past entries once no older entry is pending,
+    so entries of a batch that failed or timed out are never skipped when
+    they're claimed later, even if a newer batch was processed before.
+
+    Args:
+        user (str): The identifier of the user session.
+        new_entries (list): Entries read from the consumer group.
+        claimed (List[str]): IDs of the entries claimed from other consumers.
+    """
+    key = f"{STREAM_KEY}:{user}"
+    checkpoint = await redis_client.hget(CHECKPOINT_KEY, user)
+    ids = sorted((entry_id for entry_id, _ in new_entries), key=parse_stream_id)
+    claimed = set(claimed)
+    fresh = [
+        entry_id for entry_id in ids
+        if checkpoint is None or entry_id in claimed
+        or parse_stream_id(entry_id) > parse_stream_id(checkpoint)
+    ]
+    logger.info(f"{len(fresh)} new entries for user {user}")
+    if fresh:
+        first_ms = parse_stream_id(fresh[0])[0]
+        messages, stored = await read_lookback(user, first_ms - 2 * PAIRING_WINDOW_MS, fresh[-1])
+        paired = await process_chat_entries(
+            user,
+            messages,
+            since_ms=first_ms - PAIRING_WINDOW_MS,
+            stored=stored,
+        )
+        stored.update(paired)
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.xack(key, CONSUMER_GROUP, *ids)
+        pipe.xpending(key, CONSUMER_GROUP)
+        _, pending = await pipe.execute()
+    if not fresh:
+        return
+    last = parse_stream_id(fresh[-1])
+    if pending["min"] and parse_stream_id(pending["min"]) < last:
+        return
+    if checkpoint is None or last > parse_stream_id(checkpoint):
+        await redis_client.hset(CHECKPOINT_KEY, user, fresh[-1])
+
+async def _process(user: str, entries: list, claimed: List[str] = ()) -> None:
+    """
+    Processes a session, up to STREAM_CONCURRENCY sessions at a time.
+    Each session is isolated: if it fails or takes longer than
+    STREAM_SESSION_TIMEOUT seconds, its entries are not acknowledged (so
+    they are claimed and processed again later) and the other sessions
+    go on.
+    """
+    async with _semaphore:
+        try:
+            await asyncio.wait_for(process_session(user, entries, claimed), STREAM_SESSION_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Processing timed out for user {user}")
+        except Exception as e:
+            logger.error(f"Error processing entries for user {user}: {e}")
+
+def start_processing(user: str, entries: list, claimed: List[str] = ()) -> None:
+    """
+    Starts processing the entries of a session in the background. The
+    session isn't read again until it's done, so entries of a session
+    are always processed in order.
+
+    Args:
+        user (str): The identifier of the user session.
+        entries (list): Entries read from the consumer group.
+        claimed (List[str]): IDs of the entries claimed from other consumers.
+    """
+    task = asyncio.create_task(_process(user, entries, claimed))
+    _in_flight[user] = task
+    task.add_done_callback(lambda _: _in_flight.pop(user, None))
+
+def due_sessions(sessions: List[str], activity: Dict[str, int]) -> List[str]:
+    """
+    Returns the sessions to read without waiting, backlog first: sessions
+    with entries left unread by the per-pass budget, sessions with new
+    messages in the registry, and idle sessions whose backoff is over.
+    Sessions being processed are skipped.
+
+    Args:
+        sessions (List[str]): Sessions owned by this worker.
+        activity (Dict[str, int]): Time of the last message of each session.
+
+    Returns:
+        List[str]: Sessions to read.
+    """
+    now = time.monotonic()
+    backlog, active, idle = [], [], []
+    for user in sessions:
+        if user in _in_flight:
+            continue
+        state = _schedule.setdefault(user, {"seen": 0, "backlog": False, "idle": 0, "next": 0})
+        if state["backlog"]:
+            backlog.append(user)
+        elif activity.get(user, 0) > state["seen"]:
+            active.append(user)
+        elif now >= state["next"]:
+            idle.append(user)
+    return backlog + active + idle
+
+def update_schedule(sessions: List[str], activity: Dict[str, int], entries: Dict[str, list]) -> None:
+    """
+    Updates the scheduling state of sessions after reading them. Sessions
+    that got a full page have a backlog, and sessions without entries are
+    read less often (exponential backoff, up to STREAM_IDLE_BACKOFF_MAX_MS).
+
+    Args:
+        sessions (List[str]): Sessions that were read.
+        activity (Dict[str, int]): Time of the last message of each session.
+        entries (Dict[str, list]): Entries read for each session.
+    """
+    now = time.monotonic()
+    for user in sessions:
+        state = _schedule.setdefault(user, {"seen": 0, "backlog": False, "idle": 0, "next": 0})
+        count = len(entries.get(user, []))
+        state["seen"] = activity.get(user, 0)
+        state["backlog"] = count >= STREAM_READ_COUNT
+        state["idle"] = 0 if count else state["idle"] + 1
+        backoff = min(IDLE_BACKOFF_MS * 2 ** min(state["idle"], 16), STREAM_IDLE_BACKOFF_MAX_MS)
+        state["next"] = now + backoff / 1000
+
+async def queue_depths(sessions: List[str]) -> Dict[str, Dict[str, int]]:
+    """
+    Returns the queue depth of sessions: entries not read yet by the
+    consumer group (lag) and entries read but not acknowledged (pending).
+
+    Args:
+        sessions (List[str]): The identifiers of the user sessions.
+
+    Returns:
+        Dict[str, Dict[str, int]]: Lag and pending entries for each session.
+    """
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for user in sessions:
+            pipe.xinfo_groups(f"{STREAM_KEY}:{user}")
+        results = await pipe.execute(raise_on_error=False)
+
+    depths = {}
+    for user, groups in zip(sessions, results):
+        if isinstance(groups, Exception):
+            continue
+        for group in groups:
+            if group["name"].decode("utf-8") == CONSUMER_GROUP:
+                depths[user] = {
+                    "lag": group.get("lag") or 0,
+                    "pending": group["pending"],
+                }
+    return depths
+
+async def _sleep(seconds: float, stop: asyncio.Event | None) -> None:
+    # Sleep, waking up early if the listener is stopped
+    if stop is None:
+        await asyncio.sleep(seconds)
+        return
+    try:
+        await asyncio.wait_for(stop.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+async def stream_listener(stop: asyncio.Event | None = None) -> None:
+    """
+    Main asynchronous listener loop that processes Redis streams for the
+    active user sessions owned by this worker (see `get_sessions` and
+    `assign_sessions`).
+
+    Sessions are scheduled fairly: each read takes at most STREAM_READ_COUNT
+    entries per session, and sessions are processed in the background (see
+    `start_processing`), so a flood in a big group can't delay other live
+    maps. Sessions with a backlog or new messages are read right away, and
+    idle sessions are read less often (see `due_sessions`). When no session
+    is due, it blocks on XREADGROUP until any of them has new messages.
+
+    Every STREAM_LISTENER_TIME seconds, it also claims entries left pending
+    by other consumers and cleans up old messages from each stream if
     cleanup is not disabled via the DISABLE_STREAM_CLEANUP setting.
 
-    This function runs continuously, sleeping between iterations as defined by 
-    STREAM_LISTENER_TIME (in seconds).
+    Leases are renewed by a separate heartbeat task (see `lease_heartbeat`),
+    so they're kept while sessions take long to process.
+
+    If a stop event is given, the loop exits once it's set, after finishing
+    the sessions in progress, and releases its sessions to other workers.
+
+    Args:
+        stop (asyncio.Event | None): Event to stop the listener gracefully.
 
     Side Effects:
         - Processes chat entries using `process_chat_entries`.
+        - Creates consumer groups and acknowledges entries.
+        - Acquires, renews and releases session leases.
         - May delete old entries from Redis streams depending on cleanup settings.
     """
-    while True:
+    last_maintenance = 0
+    last_assignment = 0
+    owned = []
+    registered = False
+    heartbeat = asyncio.create_task(lease_heartbeat())
+    try:
+        while not (stop and stop.is_set()):
+            try:
+                if not registered:
+                    await register_sessions()
+                    registered = True
+                sessions = await get_sessions()
+                if time.monotonic() - last_assignment >= STREAM_LEASE_MS / 3000:
+                    owned = await assign_sessions(list(sessions))
+                    last_assignment = time.monotonic()
+                    for user in set(_schedule) - set(owned):
+                        del _schedule[user]
+                    for user in set(_lookback) - set(owned) - set(_in_flight):
+                        del _lookback[user]
+                # Sessions whose lease was lost are dropped by the heartbeat
+                owned = [user for user in _owned if user in sessions]
+                if not owned:
+                    await _sleep(STREAM_BLOCK_MS / 1000, stop)
+                    continue
+                for user in owned:
+                    await ensure_group(user)
+
+                readable = [user for user in owned if user not in _in_flight]
+                due = due_sessions(readable, sessions)
+                if due:
+                    read = due
+                    new_entries = await read_entries(due, block=None)
+                elif readable:
+                    read = readable
+                    new_entries = await read_entries(
+                        readable,
+                        block=BUSY_BLOCK_MS if _in_flight else STREAM_BLOCK_MS,
+                    )
+                else:
+                    # Every session is being processed
+                    read, new_entries = [], {}
+                    await asyncio.wait(
+                        list(_in_flight.values()),
+                        timeout=STREAM_BLOCK_MS / 1000,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                update_schedule(read, sessions, new_entries)
+
+                maintenance = time.monotonic() - last_maintenance >= STREAM_LISTENER_TIME
+                claimed_ids = {}
+                if maintenance:
+                    for user in owned:
+                        if user in _in_flight:
+                            continue
+                        claimed = await claim_entries(user)
+                        if claimed:
+                            logger.info(f"{len(claimed)} pending entries claimed for user {user}")
+                            new_entries[user] = claimed + new_entries.get(user, [])
+                            claimed_ids[user] = [entry_id for entry_id, _ in claimed]
+
+                for user, entries in new_entries.items():
+                    start_processing(user, entries, claimed_ids.get(user, ()))
+
+                if maintenance:
+                    last_maintenance = time.monotonic()
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Queue depths: {await queue_depths(owned)}")
+                    # Cleanup old messages
+                    if not DISABLE_STREAM_CLEANUP:
+                        await cleanup(owned)
+            except Exception as e:
+                logger.info("[stream_listener] Error processing data %s", e)
+                await _sleep(STREAM_LISTENER_TIME, stop)
+        # Drain sessions in progress
+        if _in_flight:
+            await asyncio.gather(*_in_flight.values(), return_exceptions=True)
+    finally:
+        heartbeat.cancel()
+        for task in list(_in_flight.values()):
+            task.cancel()
         try:
-            sessions = await get_sessions()
-            for user in sessions:
-                entries = await redis_client.xrange(f'{STREAM_KEY}:{user}', min='-', max='+')
-                logger.info(f"{len(entries)} entries for user {user}")
-                await process_chat_entries(user, entries)
-                # Cleanup old messages
-                if not DISABLE_STREAM_CLEANUP:
-                    await cleanup(user)
+            await release_sessions()
         except Exception as e:
-            logger.info("[stream_listener] Error processing data %s", e)
-        await asyncio.sleep(STREAM_LISTENER_TIME)
+            logger.warning(f"Failed to release sessions: {e}")
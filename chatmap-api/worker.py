@@ -0,0 +1,57 @@
+"""
+Standalone ingestion worker. Runs only the Redis stream pipeline (no HTTP
+API), so ingestion can be scaled independently from the API. Run the API
+with CHATMAP_STREAM_LISTENER_ENABLED=false when using it.
+
+On SIGTERM or SIGINT, the worker stops reading new messages, finishes the
+sessions in progress (up to CHATMAP_STREAM_DRAIN_TIMEOUT seconds) and
+releases its sessions to the other workers.
+"""
+
+import os
+import signal
+import logging
+import asyncio
+from stream import stream_listener
+from storage import start_s3, stop_s3
+from data import shutdown_ingest, close_http_client
+from derivatives import shutdown_derivatives
+from monitoring import monitor_event_loop
+from settings import DEBUG, MEDIA_FOLDER, STREAM_DRAIN_TIMEOUT
+
+# Logs
+logging.basicConfig(
+    format='[WORKER] %(levelname)s: %(message)s',
+    level=logging.DEBUG if DEBUG else logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+async def main() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    if not os.path.exists(MEDIA_FOLDER):
+        os.mkdir(MEDIA_FOLDER)
+    await start_s3()
+    monitor = asyncio.create_task(monitor_event_loop())
+    listener = asyncio.create_task(stream_listener(stop))
+    logger.info("Ingestion worker started")
+
+    await stop.wait()
+    logger.info("Stopping, draining sessions in progress ...")
+    try:
+        await asyncio.wait_for(listener, STREAM_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Stream listener didn't stop in time")
+    monitor.cancel()
+    shutdown_derivatives()
+    shutdown_ingest()
+    await close_http_client()
+    await stop_s3()
+    logger.info("Ingestion worker stopped")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -71,6 +71,10 @@ const (
     // QRCodeExpiry is the maximum duration the client will wait for a
     // QR code to be generated before giving up.
     QRCodeExpiry = 10 * time.Second
+
+    // SessionsKey is the Redis sorted set of sessions with messages,
+    // scored by the time of their last message (in milliseconds).
+    SessionsKey = "sessions"
 )
 
 // List of messages
@@ -729,23 +733,35 @@ func handleMessage(sessionID string, v *events.Message, enc_key string) {
     // Save data into Redis queue
     if (hasContent) {
         userId := hash(client.Store.ID.User)
-        redisClient.XAdd(ctx, &redis.XAddArgs{
-            Stream: fmt.Sprintf("messages:%s", sessionID),
-            ID:     streamID,
-            Values: map[string]interface{}{
-                "id":      streamID,
-                "user":    userId,
-                "from":    hash(message.From),
-                "chat":    hash(message.Chat),
-                "text":    message.Text,
-                "date":    message.Date,
-                "location": message.Location,
-                "photo": message.Photo,
-                "video": message.Video,
-                "audio": message.Audio,
-                "file": message.File,
-            },
+        _, err := redisClient.TxPipelined(ctx, func(pipe redis.Pipeliner) error {
+            pipe.XAdd(ctx, &redis.XAddArgs{
+                Stream: fmt.Sprintf("messages:%s", sessionID),
+                ID:     streamID,
+                Values: map[string]interface{}{
+                    "id":      streamID,
+                    "user":    userId,
+                    "from":    hash(message.From),
+                    "chat":    hash(message.Chat),
+                    "text":    message.Text,
+                    "date":    message.Date,
+                    "location": message.Location,
+                    "photo": message.Photo,
+                    "video": message.Video,
+                    "audio": message.Audio,
+                    "file": message.File,
+                },
+            })
+            // Register the session activity, so the API only reads active streams
+            pipe.ZAdd(ctx, SessionsKey, redis.Z{
+                Score:  float64(time.Now().UnixMilli()),
+                Member: sessionID,
+            })
+            return nil
         })
+        if err != nil {
+            log.Printf("Failed to save message: %v", err)
+            return
+        }
         log.Printf("Saved received message")
     }
 